@@ -0,0 +1,355 @@
+# synthetic workloads to measure the DB engine: throughput, commit latency, abort rate and peak memory
+# usage: python benchmark.py [--suite] [--transactions N] [--read-ratio R] [--read-only F] [--skew S]
+#	[--failure-rate P] [--recovery-rate P] [--sites N] [--vars N] [--concurrency N] [--seed N] [--trace PATH]
+#	[--log-dir DIR [--fsync POLICY]]
+
+import argparse
+import random
+import time
+import tracemalloc
+from bisect import bisect
+from itertools import accumulate
+from project import DB, run_trace
+from placement_util import Placement
+from deadlock_detect_util import find_deadlocked_sccs
+from instruction_util import Op, format_instruction
+from commit_log_util import FSYNC_POLICIES
+from output_sink_util import AbortReason, NullSink, RecordSink
+
+# parameters of a synthetic workload
+#	num_of_transactions: transactions to run, each one begins, issues ops_per_transaction reads/writes and ends
+#	read_ratio: probability that an op of a read-write transaction is a read
+#	read_only_fraction: probability that a transaction is read-only
+#	skew: variable i is picked with weight 1 / i ** skew, 0 means uniform, larger means hotter low variables
+#	failure_rate: probability, before each op, that an up site fails
+#	recovery_rate: probability, before each op, that a failed site recovers
+#	num_of_sites, num_of_vars: placement of the default rule, see placement_util
+#	concurrency: transactions open at the same time
+class Workload:
+	def __init__(self, num_of_transactions=1000, read_ratio=0.5, read_only_fraction=0.1, skew=0.0,
+			failure_rate=0.0, recovery_rate=0.1, num_of_sites=10, num_of_vars=20, concurrency=8,
+			ops_per_transaction=4, seed=0):
+		self.num_of_transactions = num_of_transactions
+		self.read_ratio = read_ratio
+		self.read_only_fraction = read_only_fraction
+		self.skew = skew
+		self.failure_rate = failure_rate
+		self.recovery_rate = recovery_rate
+		self.num_of_sites = num_of_sites
+		self.num_of_vars = num_of_vars
+		self.concurrency = concurrency
+		self.ops_per_transaction = ops_per_transaction
+		self.seed = seed
+		self.num_of_helpers = 0 # empty transactions ops() ran to retry waiting commands
+		self.num_of_converted_reads = 0 # reads ops() issued as writes because no site could serve them
+		self.num_of_skipped_reads = 0 # reads of read-only transactions ops() dropped because no site could serve them
+		self.cum_weights = list(accumulate(1 / var ** skew for var in range(1, num_of_vars + 1)))
+
+	def placement(self):
+		return Placement(self.num_of_sites, self.num_of_vars)
+
+	def pick_var(self, rng):
+		return bisect(self.cum_weights, rng.random() * self.cum_weights[-1]) + 1
+
+	# generator of op tuples, acts as a client keeping `concurrency` transactions open
+	# it looks at tm between two ops, so a transaction only issues its next op when it doesn't wait;
+	# the ops are an ordinary trace (see --trace), executing them on a fresh DB gives the same outcomes
+	def ops(self, tm):
+		rng = random.Random(self.seed)
+		self.num_of_helpers = 0
+		self.num_of_converted_reads = 0
+		self.num_of_skipped_reads = 0
+		remaining = {} # key: open transaction, value: reads/writes it still has to issue
+		down = set()
+		begun = 0
+		nudged = False # an empty transaction ended since the last op that made progress
+
+		while begun < self.num_of_transactions or remaining:
+			if self.failure_rate and len(down) < self.num_of_sites and rng.random() < self.failure_rate:
+				site = rng.choice([s for s in range(1, self.num_of_sites + 1) if s not in down])
+				down.add(site)
+				nudged = False # it may have aborted the last helper
+				yield (Op.FAIL, site)
+				continue
+			if down and rng.random() < self.recovery_rate:
+				site = rng.choice(sorted(down))
+				down.discard(site)
+				yield (Op.RECOVER, site)
+				continue
+
+			ready = [t for t in remaining if not tm.waits_for.is_waiting(t) and not tm.waiting.commands_of(t)]
+			# open a new transaction when there is room, or when every open one waits (those are skipped until they can go on)
+			if begun < self.num_of_transactions and (len(remaining) < self.concurrency or not ready):
+				begun += 1
+				remaining[begun] = self.ops_per_transaction
+				yield (Op.BEGIN_RO if rng.random() < self.read_only_fraction else Op.BEGIN, begun)
+				continue
+
+			if not ready:
+				if down:
+					site = min(down)
+					down.discard(site)
+					yield (Op.RECOVER, site)
+					continue
+				# every open transaction waits: end the victim of a deadlock, detection at end aborts it
+				victims = [victim for scc, victim in find_deadlocked_sccs(tm.waits_for.out_edges, lambda t: tm.transactions[t].start_time)]
+				if victims:
+					t = min(victims)
+					del remaining[t]
+					yield (Op.END, t)
+					continue
+				# no deadlock: reads wait for sites that recovered, they are only retried at an end, and a replicated
+				# variable is only readable at a recovered site once it's written again; so run a helper transaction
+				# (numbered after the workload's ones) that writes the variables no site can serve and ends
+				if nudged:
+					raise RuntimeError("workload stalled: %s wait for sites that can't serve them" % tm.waiting)
+				nudged = True
+				self.num_of_helpers += 1
+				t = self.num_of_transactions + self.num_of_helpers
+				yield (Op.BEGIN, t)
+				for var in sorted(set(command.args[1] for command in tm.waiting)):
+					if tm.find_read_site(var, False) is None:
+						yield (Op.WRITE, t, var, rng.randrange(1000))
+				# a blocked helper ends like any transaction once it doesn't wait anymore
+				remaining[t] = 0
+				continue
+
+			t = rng.choice(ready)
+			if t <= self.num_of_transactions:
+				nudged = False
+			tx = tm.transactions[t]
+			if remaining[t] == 0 or tx.status == tm.ABORT:
+				del remaining[t]
+				yield (Op.END, t)
+				continue
+			remaining[t] -= 1
+			var = self.pick_var(rng)
+			is_read = tx.is_read_only or rng.random() < self.read_ratio
+			# a read no site can serve right now isn't issued: it would wait for a site, and such waits aren't edges
+			# of the wait-for graph, so the locks its transaction holds could block every writer, helpers included;
+			# a read-write transaction writes instead and a read-only transaction skips the read, both are counted
+			if is_read and tm.find_read_site(var, tx.is_read_only) is None:
+				if tx.is_read_only:
+					self.num_of_skipped_reads += 1
+					continue
+				self.num_of_converted_reads += 1
+				is_read = False
+			if is_read:
+				yield (Op.READ, t, var)
+			else:
+				yield (Op.WRITE, t, var, rng.randrange(1000))
+
+# sink that only counts outcomes, so output formatting isn't measured
+# transactions numbered above num_of_transactions are helpers of Workload.ops and aren't counted
+class OutcomeCounter(NullSink):
+	def __init__(self, num_of_transactions=None):
+		self.num_of_transactions = num_of_transactions
+		self.reads = 0
+		self.committed = []
+		self.aborts = {reason: 0 for reason in AbortReason}
+
+	def counts(self, transaction):
+		return self.num_of_transactions is None or transaction <= self.num_of_transactions
+
+	def read(self, transaction, var, value):
+		if self.counts(transaction):
+			self.reads += 1
+
+	def commit(self, transaction):
+		if self.counts(transaction):
+			self.committed.append(transaction)
+
+	def abort(self, transaction, reason=AbortReason.UNKNOWN):
+		if self.counts(transaction):
+			self.aborts[reason] += 1
+
+# run workload on a fresh DB
+# trace: text file object the executed ops are written to, None for no trace
+# log_dir, fsync: commit logs of the sites, see DB, emptied first; recoveries then replay the logs
+# output: dict of measurements, only the time spent executing ops counts (not generating them)
+def run_benchmark(workload, trace=None, log_dir=None, fsync="tick"):
+	counter = OutcomeCounter(workload.num_of_transactions)
+	db = DB(workload.placement(), counter, log_dir, fsync, truncate_logs=True)
+	tm = db.tm
+
+	num_of_ops = 0
+	num_of_recoveries = 0
+	recovery_seconds = 0.0
+	elapsed = 0.0
+	for op in workload.ops(tm):
+		start = time.perf_counter()
+		tm.execute(op)
+		seconds = time.perf_counter() - start
+		elapsed += seconds
+		if op[0] == Op.RECOVER:
+			recovery_seconds += seconds
+			num_of_recoveries += 1
+		num_of_ops += 1
+		if trace is not None:
+			trace.write(format_instruction(op) + "\n")
+	db.close()
+
+	latencies = sorted(tm.transactions[t].end_time - tm.transactions[t].start_time for t in counter.committed)
+	num_of_aborts = sum(counter.aborts.values())
+	return {
+		"ops": num_of_ops,
+		"seconds": elapsed,
+		"ops_per_sec": num_of_ops / elapsed if elapsed > 0 else float("inf"),
+		"reads": counter.reads,
+		"commits": len(counter.committed),
+		"aborts": num_of_aborts,
+		"deadlock_aborts": counter.aborts[AbortReason.DEADLOCK],
+		"failure_aborts": counter.aborts[AbortReason.SITE_FAILURE],
+		"abort_rate": num_of_aborts / max(1, num_of_aborts + len(counter.committed)),
+		"latency_mean": sum(latencies) / len(latencies) if latencies else 0,
+		"latency_p50": percentile(latencies, 50),
+		"latency_p99": percentile(latencies, 99),
+		"latency_max": latencies[-1] if latencies else 0,
+		"recoveries": num_of_recoveries,
+		"recovery_seconds": recovery_seconds,
+		"helpers": workload.num_of_helpers,
+		"converted_reads": workload.num_of_converted_reads,
+		"skipped_reads": workload.num_of_skipped_reads,
+	}
+
+# output: peak memory in bytes traced by tracemalloc while running workload (a separate run, tracing slows it down)
+def measure_peak_memory(workload, log_dir=None, fsync="tick"):
+	tracemalloc.start()
+	try:
+		run_benchmark(workload, log_dir=log_dir, fsync=fsync)
+		return tracemalloc.get_traced_memory()[1]
+	finally:
+		tracemalloc.stop()
+
+# latencies: sorted list
+def percentile(latencies, p):
+	if not latencies:
+		return 0
+	return latencies[min(len(latencies) - 1, len(latencies) * p // 100)]
+
+def report(name, result):
+	print("%s:" % name)
+	print("    ops: %d in %.3f s, %.0f ops/sec" % (result["ops"], result["seconds"], result["ops_per_sec"]))
+	print("    commits: %d, reads: %d" % (result["commits"], result["reads"]))
+	if result["converted_reads"] or result["skipped_reads"]:
+		print("    reads no site could serve: %d issued as writes, %d skipped (read-only)" % (result["converted_reads"], result["skipped_reads"]))
+	if result["helpers"]:
+		print("    helper transactions: %d" % result["helpers"])
+	print("    commit latency (ticks): mean %.1f, p50 %d, p99 %d, max %d" % (result["latency_mean"], result["latency_p50"], result["latency_p99"], result["latency_max"]))
+	print("    abort rate: %.2f%% (deadlock %d, site failure %d)" % (100 * result["abort_rate"], result["deadlock_aborts"], result["failure_aborts"]))
+	if result["recoveries"]:
+		print("    recoveries: %d, %.3f ms each" % (result["recoveries"], 1000 * result["recovery_seconds"] / result["recoveries"]))
+	if "peak_memory" in result:
+		print("    peak memory: %.2f MB" % (result["peak_memory"] / 2 ** 20))
+
+# key: name, value: workload parameters (besides the common ones of the command line)
+SUITE = {
+	"uniform": dict(read_ratio=0.5, read_only_fraction=0.1, skew=0.0),
+	"read-heavy": dict(read_ratio=0.9, read_only_fraction=0.3, skew=0.0),
+	"hot-spot": dict(read_ratio=0.5, read_only_fraction=0.1, skew=1.5),
+	"failures": dict(read_ratio=0.5, read_only_fraction=0.1, skew=0.5, failure_rate=0.01, recovery_rate=0.2),
+}
+
+
+# =============== TESTS ==================
+
+def test_workload():
+	import io
+	workload = Workload(num_of_transactions=200, skew=1.0, failure_rate=0.02, seed=3)
+	trace = io.StringIO()
+	result = run_benchmark(workload, trace)
+	assert(result["commits"] + result["aborts"] == 200)
+	assert(result["deadlock_aborts"] > 0 and result["failure_aborts"] > 0)
+
+	# the trace replays to the same outcomes
+	counter = OutcomeCounter(workload.num_of_transactions)
+	db = DB(workload.placement(), counter)
+	for line in trace.getvalue().splitlines():
+		db.tm.read_in_instruction(line)
+	assert(len(counter.committed) == result["commits"] and counter.reads == result["reads"])
+
+	# batch mode: a read woken by an end runs before a failure later in the batch, like one by one (input17.txt)
+	lines = ["begin(T3)", "begin(T1)", "begin(T2)", "W(T3,x2,22)", "W(T2,x3,44)", "R(T3,x3)", "end(T2)", "fail(4)", "end(T3)",
+		"R(T1,x2)", "end(T1)", "dump()"]
+	outcomes = []
+	for batch_size in (None, 2, 3, 5, 100):
+		sink = RecordSink()
+		run_trace(lines, batch_size, sink)
+		outcomes.append(sink.records)
+	assert(outcomes[0][:3] == [("commit", 2), ("read", 3, 3, 44), ("abort", 3, AbortReason.SITE_FAILURE)])
+	assert(all(records == outcomes[0] for records in outcomes))
+
+	# sites recovering from commit logs end up with the same outcomes
+	import tempfile
+	with tempfile.TemporaryDirectory() as log_dir:
+		logged = run_benchmark(workload, log_dir=log_dir)
+	assert((logged["commits"], logged["reads"], logged["aborts"]) == (result["commits"], result["reads"], result["aborts"]))
+
+	# a write of a transaction aborted by the failure doesn't survive the recovery from the log
+	with tempfile.TemporaryDirectory() as log_dir:
+		sink = RecordSink()
+		db = DB(Placement(), sink, log_dir)
+		for line in ["begin(T1)", "W(T1,x1,999)", "fail(2)", "recover(2)", "begin(T2)", "R(T2,x1)"]:
+			db.tm.read_in_instruction(line)
+		db.close()
+		assert(sink.records == [("read", 2, 1, 10)])
+
+		# committed values survive a restart: a new DB on the same logs starts with them
+		db = DB(Placement(), NullSink(), log_dir)
+		for line in ["begin(T3)", "W(T3,x2,222)", "W(T3,x3,333)", "end(T3)"]:
+			db.tm.read_in_instruction(line)
+		db.close()
+		sink = RecordSink()
+		db = DB(Placement(), sink, log_dir)
+		for line in ["begin(T4)", "R(T4,x2)", "R(T4,x3)", "end(T4)", "beginRO(T5)", "R(T5,x2)", "end(T5)"]:
+			db.tm.read_in_instruction(line)
+		db.tm.read_in_instruction("dump()")
+		db.close()
+		assert(sink.records[:5] == [("read", 4, 2, 222), ("read", 4, 3, 333), ("commit", 4), ("read", 5, 2, 222), ("commit", 5)])
+		assert(("dump", 4, [(var, 222 if var == 2 else 333 if var == 3 else var * 10) for var in Placement().vars_at(4)]) in sink.records)
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark the DB engine on synthetic workloads")
+	parser.add_argument("--suite", action="store_true", help="run every workload of SUITE instead of the one given by the options")
+	parser.add_argument("--transactions", type=int, default=1000)
+	parser.add_argument("--read-ratio", type=float, default=0.5, help="probability that an op of a read-write transaction is a read")
+	parser.add_argument("--read-only", type=float, default=0.1, help="fraction of read-only transactions")
+	parser.add_argument("--skew", type=float, default=0.0, help="variable i is picked with weight 1 / i ** skew")
+	parser.add_argument("--failure-rate", type=float, default=0.0, help="probability of a site failure before each op")
+	parser.add_argument("--recovery-rate", type=float, default=0.1, help="probability of a site recovery before each op")
+	parser.add_argument("--sites", type=int, default=10)
+	parser.add_argument("--vars", type=int, default=20)
+	parser.add_argument("--concurrency", type=int, default=8, help="transactions open at the same time")
+	parser.add_argument("--ops-per-transaction", type=int, default=4)
+	parser.add_argument("--seed", type=int, default=0)
+	parser.add_argument("--no-memory", action="store_true", help="skip the tracemalloc run measuring peak memory")
+	parser.add_argument("--trace", metavar="PATH", help="write the generated trace to PATH (single workload only)")
+	parser.add_argument("--log-dir", metavar="DIR", help="keep a commit log per site in DIR, failed sites recover from it")
+	parser.add_argument("--fsync", choices=FSYNC_POLICIES, default="tick", help="when commit logs are synced to disk (default: tick)")
+	parser.add_argument("--test", action="store_true", help="run the self test and exit")
+	args = parser.parse_args()
+
+	if args.test:
+		test_workload()
+		return
+
+	common = dict(num_of_transactions=args.transactions, num_of_sites=args.sites, num_of_vars=args.vars,
+		concurrency=args.concurrency, ops_per_transaction=args.ops_per_transaction, seed=args.seed)
+	if args.suite:
+		workloads = [(name, Workload(**dict(common, **params))) for name, params in SUITE.items()]
+	else:
+		workloads = [("workload", Workload(read_ratio=args.read_ratio, read_only_fraction=args.read_only, skew=args.skew,
+			failure_rate=args.failure_rate, recovery_rate=args.recovery_rate, **common))]
+
+	for name, workload in workloads:
+		if args.trace is not None and not args.suite:
+			with open(args.trace, "w") as trace:
+				result = run_benchmark(workload, trace, args.log_dir, args.fsync)
+		else:
+			result = run_benchmark(workload, log_dir=args.log_dir, fsync=args.fsync)
+		if not args.no_memory:
+			result["peak_memory"] = measure_peak_memory(workload, args.log_dir, args.fsync)
+		report(name, result)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,102 @@
+# per-site append-only commit log: every committed value of a site, in commit order
+# a DM with a log can lose its committed versions on failure and rebuild them from the log when it recovers,
+# an existing log is kept and appended to, so a DM built on it after a restart starts with its committed versions
+# record: little endian var (i32), value (i64), commit time (i64), 20 bytes
+
+import os
+import struct
+
+LOG_RECORD = struct.Struct("<iqq")
+
+# when records reach the disk
+#	always: flush and fsync after every record
+#	tick: flush and fsync once per tick with commits, i.e. a group commit of every value committed in that tick (default)
+#	never: records are buffered and left to the OS, no fsync
+FSYNC_POLICIES = ("always", "tick", "never")
+
+class CommitLog:
+	# path: the log file, created if missing, otherwise new records go after the existing ones
+	# fsync: one of FSYNC_POLICIES
+	# truncate: start with an empty log, dropping the records of an existing file
+	def __init__(self, path, fsync="tick", buffer_size=1 << 16, truncate=False):
+		if fsync not in FSYNC_POLICIES:
+			raise ValueError("unknown fsync policy: %s" % fsync)
+		self.path = path
+		self.fsync = fsync
+		self.buffer_size = buffer_size
+		self.file = open(path, "wb" if truncate else "ab", buffering=buffer_size)
+		# a record cut short by a crash is dropped
+		self.num_of_records = self.file.tell() // LOG_RECORD.size
+		self.file.truncate(self.num_of_records * LOG_RECORD.size)
+
+	def append(self, var, value, time):
+		self.file.write(LOG_RECORD.pack(var, value, time))
+		self.num_of_records += 1
+		if self.fsync == "always":
+			self.flush(True)
+
+	# end of a group commit
+	def sync(self):
+		if self.fsync == "tick":
+			self.flush(True)
+
+	def flush(self, fsync):
+		self.file.flush()
+		if fsync:
+			os.fsync(self.file.fileno())
+
+	# output: generator of (var, value, time) of every record, in commit order
+	def replay(self, chunk_records=1 << 12):
+		self.file.flush()
+		with open(self.path, "rb") as f:
+			while True:
+				chunk = f.read(LOG_RECORD.size * chunk_records)
+				if not chunk:
+					return
+				for record in LOG_RECORD.iter_unpack(chunk):
+					yield record
+
+	def close(self):
+		self.file.close()
+
+	# a checkpoint keeps the path, policy and length of the log, the restored log drops records appended
+	# after the checkpoint and appends to the same file
+	def __getstate__(self):
+		self.file.flush()
+		return {"path": self.path, "fsync": self.fsync, "buffer_size": self.buffer_size, "num_of_records": self.num_of_records}
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self.file = open(self.path, "ab", buffering=self.buffer_size)
+		self.file.truncate(self.num_of_records * LOG_RECORD.size)
+
+
+# =============== TESTS ==================
+
+def test_commit_log():
+	import tempfile
+	with tempfile.TemporaryDirectory() as log_dir:
+		log = CommitLog(os.path.join(log_dir, "site1.log"))
+		log.append(2, 102, 5)
+		log.append(1, -7, 5)
+		log.sync()
+		log.append(2, 202, 9)
+		assert(list(log.replay()) == [(2, 102, 5), (1, -7, 5), (2, 202, 9)])
+		assert(os.path.getsize(log.path) == 3 * LOG_RECORD.size)
+		log.close()
+
+		# reopening keeps the records, a torn last record is dropped, truncate starts over
+		with open(log.path, "ab") as f:
+			f.write(b"torn")
+		log = CommitLog(log.path)
+		log.append(3, 33, 12)
+		assert(list(log.replay()) == [(2, 102, 5), (1, -7, 5), (2, 202, 9), (3, 33, 12)])
+		log.close()
+		log = CommitLog(log.path, truncate=True)
+		assert(log.num_of_records == 0 and list(log.replay()) == [])
+		log.close()
+
+def main():
+	test_commit_log()
+if __name__ == '__main__':
+	main()
@@ -66,6 +66,184 @@ def detail_and_append_found_cycle(origin_node, cur_stack):
 	return cycle_only_stack
 
 
+# iterative version of Tarjan's strongly connected components algorithm
+# https://en.wikipedia.org/wiki/Tarjan%27s_strongly_connected_components_algorithm
+# a scc is deadlocked if it has more than one node or a node waits for itself
+# node state lives in integer lists indexed by discovery order instead of a dict of Status values,
+# and an explicit stack of (node id, out-edge iterator) replaces recursion
+# input:
+#	graph: dict, key - node, value - iterable of outgoing nodes
+#	victim_key: function of a node, the node with the largest key is the victim (default: the node itself)
+#	roots: nodes to search from (default: every node in graph)
+# output: list of (scc, victim), scc is a list of nodes
+def find_deadlocked_sccs(graph, victim_key=None, roots=None):
+	if roots is None:
+		roots = list(graph.keys())
+	if victim_key is None:
+		victim_key = lambda node: node
+
+	node_ids = {} # key - node, value - discovery order
+	nodes = []
+	lowlink = []
+	on_stack = []
+	self_loop = []
+	scc_stack = []
+	deadlocks = []
+
+	for root in roots:
+		if root in node_ids:
+			continue
+		nodes.append(root)
+		lowlink.append(len(nodes) - 1)
+		on_stack.append(1)
+		self_loop.append(0)
+		node_ids[root] = len(nodes) - 1
+		scc_stack.append(len(nodes) - 1)
+		call_stack = [(len(nodes) - 1, iter(graph.get(root, ())))]
+
+		while call_stack:
+			v, out_nodes = call_stack[-1]
+			for w in out_nodes:
+				w_id = node_ids.get(w)
+				if w_id is None:
+					w_id = len(nodes)
+					node_ids[w] = w_id
+					nodes.append(w)
+					lowlink.append(w_id)
+					on_stack.append(1)
+					self_loop.append(0)
+					scc_stack.append(w_id)
+					call_stack.append((w_id, iter(graph.get(w, ()))))
+					break
+				if w_id == v:
+					self_loop[v] = 1
+				elif on_stack[w_id] and w_id < lowlink[v]:
+					lowlink[v] = w_id
+			else:
+				# all out nodes of v visited
+				call_stack.pop()
+				if call_stack:
+					parent = call_stack[-1][0]
+					if lowlink[v] < lowlink[parent]:
+						lowlink[parent] = lowlink[v]
+				if lowlink[v] == v:
+					scc = []
+					while True:
+						w_id = scc_stack.pop()
+						on_stack[w_id] = 0
+						scc.append(nodes[w_id])
+						if w_id == v:
+							break
+					if len(scc) > 1 or self_loop[v]:
+						deadlocks.append((scc, max(scc, key=victim_key)))
+	return deadlocks
+
+
+# persistent wait-for graph, updated edge by edge instead of rebuilt from a list of edges
+# a cycle can only appear when an edge is inserted, so we only search from the endpoint of new edges
+#	out_edges: key - node, value - set of nodes it waits for
+#	in_edges: key - node, value - set of nodes waiting for it
+class WaitForGraph:
+	def __init__(self):
+		self.out_edges = defaultdict(set)
+		self.in_edges = defaultdict(set)
+		self.closing_edges = [] # inserted edges that closed a cycle, checked again in pop_deadlocks
+		self.closing_edges_set = set()
+		self.suspects = set() # members of deadlocked components whose victim was just reported
+
+	# add edge: start waits for end
+	# output: the cycle closed by this edge (list of nodes) or None
+	def add_edge(self, start, end):
+		if end in self.out_edges[start]:
+			return None
+		self.out_edges[start].add(end)
+		self.in_edges[end].add(start)
+
+		cycle = self.find_path(end, start)
+		if cycle is not None and (start, end) not in self.closing_edges_set:
+			self.closing_edges.append((start, end))
+			self.closing_edges_set.add((start, end))
+		return cycle
+
+	# output: list of nodes on a path from source to target, or None
+	# only visits nodes reachable from source, so cost is the size of the affected component
+	def find_path(self, source, target):
+		if source == target:
+			return [source]
+		parent = {source: None}
+		stack = [source]
+		while stack:
+			node = stack.pop()
+			for out_node in self.out_edges.get(node, ()):
+				if out_node in parent:
+					continue
+				parent[out_node] = node
+				if out_node == target:
+					path = []
+					while out_node is not None:
+						path.append(out_node)
+						out_node = parent[out_node]
+					path.reverse()
+					return path
+				stack.append(out_node)
+		return None
+
+	def has_edge(self, start, end):
+		return start in self.out_edges and end in self.out_edges[start]
+
+	# True if node waits for any other node
+	def is_waiting(self, node):
+		return bool(self.out_edges.get(node))
+
+	# output: True if start no longer waits for any node
+	def remove_edge(self, start, end):
+		if not self.has_edge(start, end):
+			return False
+		self.out_edges[start].discard(end)
+		self.in_edges[end].discard(start)
+		if not self.in_edges[end]:
+			del self.in_edges[end]
+		if not self.out_edges[start]:
+			del self.out_edges[start]
+			return True
+		return False
+
+	# remove every edge that has other nodes waiting for node (node committed)
+	# output: list of nodes that no longer wait for any node
+	def remove_edges_to(self, node):
+		unblocked = []
+		for start in list(self.in_edges.get(node, ())):
+			if self.remove_edge(start, node):
+				unblocked.append(start)
+		return unblocked
+
+	# remove every edge that involves node (node aborted)
+	# output: list of other nodes that no longer wait for any node
+	def remove_node(self, node):
+		for end in list(self.out_edges.get(node, ())):
+			self.remove_edge(node, end)
+		return self.remove_edges_to(node)
+
+	# output: list of (scc, victim) for every deadlocked strongly connected component reachable from
+	# the edges that closed a cycle since the last call, or from the components reported last time
+	# (aborting one victim does not necessarily break every cycle of its component)
+	def pop_deadlocks(self, victim_key=None):
+		roots = [end for start, end in self.closing_edges if self.has_edge(start, end)]
+		roots.extend(n for n in self.suspects if self.is_waiting(n))
+		self.closing_edges = []
+		self.closing_edges_set = set()
+
+		deadlocks = find_deadlocked_sccs(self.out_edges, victim_key, roots)
+		self.suspects = set(n for scc, victim in deadlocks for n in scc if n != victim)
+		return deadlocks
+
+	def edges(self):
+		return [(start, end) for start in self.out_edges for end in self.out_edges[start]]
+
+	def __repr__(self):
+		return "%s" % self.edges()
+
+
 # =============== TESTS ==================
 
 def test_build_graph():
@@ -88,8 +266,45 @@ def test_find_cycle():
 	g = defaultdict(list, gg)
 	print('SECOND find_all_cycles(g)', find_all_cycles(g))
 
+def test_wait_for_graph():
+	g = WaitForGraph()
+	assert(g.add_edge(1, 2) is None)
+	assert(g.add_edge(2, 3) is None)
+	assert(g.add_edge(3, 1) == [1, 2, 3])
+	g.add_edge(4, 5)
+	assert(g.add_edge(5, 4) == [4, 5])
+
+	# removing a node breaks its cycle
+	g.remove_node(5)
+	assert([(sorted(scc), victim) for scc, victim in g.pop_deadlocks()] == [([1, 2, 3], 3)])
+	# victim not aborted yet, the component is reported again
+	assert([victim for scc, victim in g.pop_deadlocks()] == [3])
+	g.remove_node(3)
+	assert(g.pop_deadlocks() == [])
+
+	assert(g.remove_edges_to(1) == [])
+	assert(not g.is_waiting(3))
+	assert(g.is_waiting(1))
+	assert(g.remove_edges_to(2) == [1])
+
+def test_find_deadlocked_sccs():
+	# sccs: {1,2,3,4}, {8,9}, {11} (waits for itself); 5,6,7,10 are not deadlocked
+	gg = {1:[2], 2:[3], 3:[4, 2], 4:[1,5], 5:[6],6:[7],7:[8],8:[9],9:[8, 10], 11:[11]}
+	deadlocks = find_deadlocked_sccs(gg, victim_key=lambda n: -n)
+	assert(sorted((sorted(scc), victim) for scc, victim in deadlocks) == [([1, 2, 3, 4], 1), ([8, 9], 8), ([11], 11)])
+
+	# long wait chain closed into one cycle, deeper than the recursion limit
+	n = 100000
+	chain = {i: [i + 1] for i in range(n)}
+	chain[n] = [0]
+	deadlocks = find_deadlocked_sccs(chain)
+	assert(len(deadlocks) == 1 and len(deadlocks[0][0]) == n + 1 and deadlocks[0][1] == n)
+	assert(find_deadlocked_sccs({i: [i + 1] for i in range(n)}) == [])
+
 def main():
 	test_find_cycle()
+	test_find_deadlocked_sccs()
+	test_wait_for_graph()
 #	test_build_graph()
 if __name__ == '__main__':
 	main()
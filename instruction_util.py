@@ -0,0 +1,131 @@
+# parse instruction lines once into typed op tuples, so the TM never re-parses strings
+# op tuple format: (opcode, args...) where every arg is an int
+#	(Op.BEGIN, transaction)				begin(T1)
+#	(Op.BEGIN_RO, transaction)			beginRO(T1)
+#	(Op.READ, transaction, var)			R(T1,x2)
+#	(Op.WRITE, transaction, var, value)	W(T1,x2,202)
+#	(Op.END, transaction)				end(T1)
+#	(Op.FAIL, site)						fail(2)
+#	(Op.RECOVER, site)					recover(2)
+#	(Op.DUMP,)							dump()
+
+import re
+from enum import IntEnum
+
+class Op(IntEnum):
+	BEGIN = 0
+	BEGIN_RO = 1
+	READ = 2
+	WRITE = 3
+	END = 4
+	FAIL = 5
+	RECOVER = 6
+	DUMP = 7
+
+# key: instruction name, value: (opcode, prefix of each argument, "" means a plain int)
+SYNTAX = {
+	"begin": (Op.BEGIN, ("T",)),
+	"beginRO": (Op.BEGIN_RO, ("T",)),
+	"R": (Op.READ, ("T", "x")),
+	"W": (Op.WRITE, ("T", "x", "")),
+	"end": (Op.END, ("T",)),
+	"fail": (Op.FAIL, ("",)),
+	"recover": (Op.RECOVER, ("",)),
+	"dump": (Op.DUMP, ()),
+}
+
+NAMES = {opcode: name for name, (opcode, prefixes) in SYNTAX.items()}
+
+# why a line isn't executed, given to sink.error
+class LineError(IntEnum):
+	UNKNOWN_COMMAND = 1 # not a known instruction
+	BAD_ARGUMENTS = 2 # known instruction with a wrong number of arguments or a malformed one
+
+INSTRUCTION_RE = re.compile(r"\s*(\w+)\s*\((.*)\)")
+ARG_RE = re.compile(r"\s*([A-Za-z]*)\s*(-?\d+)\s*")
+
+# Output: op tuple, or None if the line isn't a known instruction
+# raises ValueError if a known instruction has wrong arguments
+def parse_instruction(line):
+	match = INSTRUCTION_RE.match(line)
+	if match is None:
+		return None
+	name, arg_str = match.groups()
+	if name not in SYNTAX:
+		return None
+	opcode, prefixes = SYNTAX[name]
+
+	raw_args = arg_str.split(",") if arg_str.strip() != "" else []
+	if len(raw_args) != len(prefixes):
+		raise ValueError("%s expects %d arguments" % (name, len(prefixes)))
+
+	op = [opcode]
+	for raw_arg, prefix in zip(raw_args, prefixes):
+		arg_match = ARG_RE.fullmatch(raw_arg)
+		if arg_match is None or arg_match.group(1) != prefix:
+			raise ValueError("bad argument %r of %s" % (raw_arg.strip(), name))
+		op.append(int(arg_match.group(2)))
+	return tuple(op)
+
+# Output: (op tuple, None), or (None, (LineError, message)) if the line isn't a valid instruction
+def check_instruction(line):
+	try:
+		op = parse_instruction(line)
+	except ValueError as e:
+		return None, (LineError.BAD_ARGUMENTS, str(e))
+	if op is None:
+		return None, (LineError.UNKNOWN_COMMAND, "unknown command")
+	return op, None
+
+# Output: (list of op tuples of the valid lines, list of (line, LineError, message) of the others), in line order
+def parse_instructions(lines):
+	ops = []
+	errors = []
+	for line in lines:
+		op, error = check_instruction(line)
+		if op is None:
+			errors.append((line.strip(),) + error)
+		else:
+			ops.append(op)
+	return ops, errors
+
+# names are only used at the I/O boundary, the TM and DMs work with the ints
+def transaction_name(t):
+	return "T%d" % t
+
+def var_name(x):
+	return "x%d" % x
+
+# inverse of parse_instruction, e.g. (Op.WRITE, 1, 2, 202) -> "W(T1,x2,202)"
+def format_instruction(op):
+	opcode = op[0]
+	name = NAMES[opcode]
+	prefixes = SYNTAX[name][1]
+	return "%s(%s)" % (name, ",".join(prefix + str(arg) for prefix, arg in zip(prefixes, op[1:])))
+
+
+# =============== TESTS ==================
+
+def test_parse_instruction():
+	assert(parse_instruction("W(T1, x2, 202) ") == (Op.WRITE, 1, 2, 202))
+	assert(parse_instruction("beginRO(T3)") == (Op.BEGIN_RO, 3))
+	assert(parse_instruction("fail(2)") == (Op.FAIL, 2))
+	assert(parse_instruction("dump()") == (Op.DUMP,))
+	assert(parse_instruction("querystate()") is None)
+	assert(transaction_name(3) == "T3" and var_name(12) == "x12")
+	for line in ["R(T1,x2)", "W(T1,x2,-5)", "end(T12)", "recover(10)", "dump()"]:
+		assert(format_instruction(parse_instruction(line)) == line)
+	try:
+		parse_instruction("W(T2 x2, 302)")
+		assert(False)
+	except ValueError:
+		pass
+	assert(check_instruction("R(T1, xa)") == (None, (LineError.BAD_ARGUMENTS, "bad argument 'xa' of R")))
+	ops, errors = parse_instructions(["begin(T1)", "querystate() ", "R(T1,x2,3)"])
+	assert(ops == [(Op.BEGIN, 1)])
+	assert(errors == [("querystate()", LineError.UNKNOWN_COMMAND, "unknown command"), ("R(T1,x2,3)", LineError.BAD_ARGUMENTS, "R expects 2 arguments")])
+
+def main():
+	test_parse_instruction()
+if __name__ == '__main__':
+	main()
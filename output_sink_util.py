@@ -0,0 +1,286 @@
+# where the TM and DMs send what happens
+# required output (read results, commits, aborts, dumps) goes to every sink as events with int arguments,
+# debug output (lock tables, wait-for graph, waiting commands ...) is only wanted if sink.verbose is True:
+# callers check it before building the message, so a quiet sink costs no formatting at all
+
+import io
+import json
+import struct
+import sys
+from enum import IntEnum
+from instruction_util import LineError, transaction_name, var_name
+
+# why a transaction aborts, given to sink.abort
+class AbortReason(IntEnum):
+	UNKNOWN = 0
+	DEADLOCK = 1 # youngest transaction of a deadlock
+	SITE_FAILURE = 2 # a site it accessed failed
+
+# discards everything
+class NullSink:
+	verbose = False
+
+	# a test of a multi-test trace starts, header is its marker line
+	def begin_test(self, header):
+		pass
+
+	def read(self, transaction, var, value):
+		pass
+
+	def commit(self, transaction):
+		pass
+
+	def abort(self, transaction, reason=AbortReason.UNKNOWN):
+		pass
+
+	# values: list of (var, last committed value) of site, in variable order
+	def dump(self, site, values):
+		pass
+
+	# a line of the trace isn't executed
+	#	time: tick of the line, line: the line without surrounding whitespace, reason: LineError, message: text of the error
+	def error(self, time, line, reason, message):
+		pass
+
+	# parts are printed like print(*parts)
+	def debug(self, *parts):
+		pass
+
+# human readable text, the format of the project spec
+#	verbose: also print debug output, like the TM always did
+#	file: where to write, None means sys.stdout at the time of writing (so redirect_stdout works)
+class TextSink(NullSink):
+	def __init__(self, verbose=True, file=None):
+		self.verbose = verbose
+		self.file = file
+
+	def out(self):
+		return sys.stdout if self.file is None else self.file
+
+	def begin_test(self, header):
+		print(header, file=self.out())
+
+	def read(self, transaction, var, value):
+		print("%s: %d" % (var_name(var), value), file=self.out())
+
+	def commit(self, transaction):
+		print("%s commits" % transaction_name(transaction), file=self.out())
+
+	def abort(self, transaction, reason=AbortReason.UNKNOWN):
+		print("%s aborts" % transaction_name(transaction), file=self.out())
+
+	def dump(self, site, values):
+		out = self.out()
+		print("site %d" % site, end = " - ", file=out)
+		for var, value in values:
+			print("%s: %d," % (var_name(var), value), end = " ", file=out)
+		print("\n", file=out)
+
+	def error(self, time, line, reason, message):
+		print("Error: %s " % message, line, file=self.out())
+
+	def debug(self, *parts):
+		if self.verbose:
+			print(*parts, file=self.out())
+
+# structured records kept in memory, for callers that check outcomes without parsing text
+# record format: tuple (kind, args...)
+#	("test", header)
+#	("read", transaction, var, value)
+#	("commit", transaction)
+#	("abort", transaction, reason)
+#	("dump", site, [(var, value), ...])
+#	("error", time, line, reason)
+class RecordSink(NullSink):
+	def __init__(self):
+		self.records = []
+
+	def begin_test(self, header):
+		self.records.append(("test", header))
+
+	def read(self, transaction, var, value):
+		self.records.append(("read", transaction, var, value))
+
+	def commit(self, transaction):
+		self.records.append(("commit", transaction))
+
+	def abort(self, transaction, reason=AbortReason.UNKNOWN):
+		self.records.append(("abort", transaction, reason))
+
+	def dump(self, site, values):
+		self.records.append(("dump", site, values))
+
+	def error(self, time, line, reason, message):
+		self.records.append(("error", time, line, reason))
+
+# send every event to each of sinks, e.g. text on stdout and a result log
+class TeeSink(NullSink):
+	def __init__(self, *sinks):
+		self.sinks = sinks
+		self.verbose = any(sink.verbose for sink in sinks)
+
+	def begin_test(self, header):
+		for sink in self.sinks:
+			sink.begin_test(header)
+
+	def read(self, transaction, var, value):
+		for sink in self.sinks:
+			sink.read(transaction, var, value)
+
+	def commit(self, transaction):
+		for sink in self.sinks:
+			sink.commit(transaction)
+
+	def abort(self, transaction, reason=AbortReason.UNKNOWN):
+		for sink in self.sinks:
+			sink.abort(transaction, reason)
+
+	def dump(self, site, values):
+		for sink in self.sinks:
+			sink.dump(site, values)
+
+	def error(self, time, line, reason, message):
+		for sink in self.sinks:
+			sink.error(time, line, reason, message)
+
+	def debug(self, *parts):
+		for sink in self.sinks:
+			if sink.verbose:
+				sink.debug(*parts)
+
+
+# result log: fixed-schema records of outcomes, meant to be diffed between runs without parsing text
+# every record has the same fields (kind, reason, id, var, value), unused fields are 0
+#	TEST:	a test of a multi-test trace starts
+#	READ:	id - transaction, var, value
+#	COMMIT:	id - transaction
+#	ABORT:	id - transaction, reason - AbortReason
+#	DUMP:	id - site, var, value (one record per variable of the site)
+#	ERROR:	id - tick of the line that isn't executed, reason - LineError
+class Outcome(IntEnum):
+	TEST = 0
+	READ = 1
+	COMMIT = 2
+	ABORT = 3
+	DUMP = 4
+	ERROR = 5
+
+# binary format: little endian kind (u8), reason (u8), id (i32), var (i32), value (i64), 18 bytes per record
+RESULT_RECORD = struct.Struct("<BBiiq")
+# ndjson format: one json object per line, keys always in this order
+RESULT_JSON = '{"kind":%d,"reason":%d,"id":%d,"var":%d,"value":%d}\n'
+RESULT_FORMATS = ("binary", "ndjson")
+
+# writes the result log to a binary file object, through a buffered writer when given a path
+#	format: "binary" or "ndjson"
+class ResultLogSink(NullSink):
+	def __init__(self, file, format="binary"):
+		if format not in RESULT_FORMATS:
+			raise ValueError("unknown result log format: %s" % format)
+		self.owns_file = isinstance(file, str)
+		self.file = open(file, "wb", buffering=1 << 16) if self.owns_file else file
+		self.binary = format == "binary"
+
+	def write(self, kind, reason, id, var, value):
+		if self.binary:
+			self.file.write(RESULT_RECORD.pack(kind, reason, id, var, value))
+		else:
+			self.file.write((RESULT_JSON % (kind, reason, id, var, value)).encode())
+
+	def begin_test(self, header):
+		self.write(Outcome.TEST, 0, 0, 0, 0)
+
+	def read(self, transaction, var, value):
+		self.write(Outcome.READ, 0, transaction, var, value)
+
+	def commit(self, transaction):
+		self.write(Outcome.COMMIT, 0, transaction, 0, 0)
+
+	def abort(self, transaction, reason=AbortReason.UNKNOWN):
+		self.write(Outcome.ABORT, reason, transaction, 0, 0)
+
+	def dump(self, site, values):
+		for var, value in values:
+			self.write(Outcome.DUMP, 0, site, var, value)
+
+	def error(self, time, line, reason, message):
+		self.write(Outcome.ERROR, reason, time, 0, 0)
+
+	def close(self):
+		if self.owns_file:
+			self.file.close()
+		else:
+			self.file.flush()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+# output: generator of (kind, reason, id, var, value) records of a result log
+# input: bytes of the whole log, or a binary file object
+def read_result_log(data, format="binary"):
+	if not isinstance(data, bytes):
+		data = data.read()
+	if format == "binary":
+		for kind, reason, id, var, value in RESULT_RECORD.iter_unpack(data):
+			yield Outcome(kind), reason, id, var, value
+	else:
+		for line in data.splitlines():
+			record = json.loads(line)
+			yield Outcome(record["kind"]), record["reason"], record["id"], record["var"], record["value"]
+
+# key: name of an output mode (command line), value: function creating its sink
+SINKS = {
+	"debug": lambda: TextSink(verbose=True),
+	"text": lambda: TextSink(verbose=False),
+	"none": NullSink,
+}
+
+def make_sink(name):
+	return SINKS[name]()
+
+
+# =============== TESTS ==================
+
+def test_sinks():
+	out = io.StringIO()
+	sink = TextSink(verbose=False, file=out)
+	sink.debug("never formatted")
+	sink.read(1, 2, 20)
+	sink.commit(1)
+	sink.dump(3, [(1, 10), (2, 20)])
+	sink.error(4, "querystate()", LineError.UNKNOWN_COMMAND, "unknown command")
+	assert(out.getvalue() == "x2: 20\nT1 commits\nsite 3 - x1: 10, x2: 20, \n\nError: unknown command  querystate()\n")
+
+	sink = RecordSink()
+	sink.read(1, 2, 20)
+	sink.abort(2, AbortReason.DEADLOCK)
+	sink.debug("dropped")
+	sink.error(3, "R(T1)", LineError.BAD_ARGUMENTS, "R expects 2 arguments")
+	assert(sink.records == [("read", 1, 2, 20), ("abort", 2, AbortReason.DEADLOCK), ("error", 3, "R(T1)", LineError.BAD_ARGUMENTS)])
+	assert(not make_sink("none").verbose and make_sink("debug").verbose)
+
+def test_result_log():
+	expected = [(Outcome.TEST, 0, 0, 0, 0), (Outcome.READ, 0, 1, 2, 20), (Outcome.ABORT, AbortReason.SITE_FAILURE, 2, 0, 0),
+		(Outcome.DUMP, 0, 3, 1, 10), (Outcome.DUMP, 0, 3, 2, -20), (Outcome.ERROR, LineError.UNKNOWN_COMMAND, 7, 0, 0)]
+	for format in RESULT_FORMATS:
+		out = io.BytesIO()
+		text = io.StringIO()
+		with ResultLogSink(out, format) as log:
+			sink = TeeSink(TextSink(verbose=False, file=text), log)
+			sink.begin_test("// Test 1")
+			sink.read(1, 2, 20)
+			sink.abort(2, AbortReason.SITE_FAILURE)
+			sink.dump(3, [(1, 10), (2, -20)])
+			sink.error(7, "querystate()", LineError.UNKNOWN_COMMAND, "unknown command")
+		assert(list(read_result_log(out.getvalue(), format)) == expected)
+		assert(text.getvalue().startswith("// Test 1\nx2: 20\nT2 aborts\n"))
+	assert(len(out.getvalue().splitlines()) == len(expected))
+
+def main():
+	test_sinks()
+	test_result_log()
+if __name__ == '__main__':
+	main()
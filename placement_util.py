@@ -0,0 +1,67 @@
+# which sites hold a copy of which variable, computed once and shared by the TM and every DM
+# default rule (the one of the project spec): 10 sites, 20 variables,
+# even variables are replicated at every site, odd variable xi is only at site i % 10 + 1, xi starts with value 10 * i
+
+from heapq import merge
+
+class Placement:
+	# input:
+	#	num_of_sites, num_of_vars: sites are numbered 1..num_of_sites, variables 1..num_of_vars
+	#	is_replicated: function of a variable, True if it has a copy at every site (default: even variables)
+	#	home_site: function of a variable, the only site of an unreplicated variable (default: var % num_of_sites + 1)
+	#	initial_value: function of a variable, its value committed at time 0 at every copy (default: 10 * var)
+	def __init__(self, num_of_sites=10, num_of_vars=20, is_replicated=None, home_site=None, initial_value=None):
+		if is_replicated is None:
+			is_replicated = lambda var: var % 2 == 0
+		if home_site is None:
+			home_site = lambda var: var % num_of_sites + 1
+		if initial_value is None:
+			initial_value = lambda var: var * 10
+
+		self.num_of_sites = num_of_sites
+		self.num_of_vars = num_of_vars
+		all_sites = tuple(range(1, num_of_sites + 1))
+
+		# indexed by variable (index 0 unused), read directly by the TM and DMs
+		# sites_of: immutable tuple of sites that have a copy, replicated variables share the all_sites tuple
+		self.sites_of = [()] * (num_of_vars + 1)
+		self.replicated = [False] * (num_of_vars + 1)
+		replicated_vars = []
+		self.unreplicated_at = [[] for i in range(num_of_sites + 1)] # indexed by site: unreplicated variables it holds
+
+		for var in range(1, num_of_vars + 1):
+			if is_replicated(var):
+				self.replicated[var] = True
+				self.sites_of[var] = all_sites
+				replicated_vars.append(var)
+			else:
+				site = home_site(var)
+				self.sites_of[var] = (site,)
+				self.unreplicated_at[site].append(var)
+		self.replicated_vars = tuple(replicated_vars)
+		# indexed by variable, one table shared by all sites, they only store values written since
+		self.initial_values = tuple(initial_value(var) for var in range(num_of_vars + 1))
+
+	# output: variables with a copy at site, in increasing order
+	def vars_at(self, site):
+		return merge(self.replicated_vars, self.unreplicated_at[site])
+
+
+# =============== TESTS ==================
+
+def test_placement():
+	p = Placement()
+	assert(p.sites_of[3] == (4,) and not p.replicated[3])
+	assert(p.sites_of[2] == tuple(range(1, 11)) and p.replicated[2])
+	assert(list(p.vars_at(2)) == [1, 2, 4, 6, 8, 10, 11, 12, 14, 16, 18, 20])
+	assert(p.initial_values[12] == 120)
+
+	p = Placement(num_of_sites=3, num_of_vars=6, is_replicated=lambda var: var % 3 == 0)
+	assert(p.sites_of[6] == (1, 2, 3))
+	assert(p.sites_of[4] == (2,))
+	assert(list(p.vars_at(1)) == [3, 6])
+
+def main():
+	test_placement()
+if __name__ == '__main__':
+	main()
@@ -1,12 +1,38 @@
-from collections import defaultdict 
-from test_cases import tests_generator
-from deadlock_detect_util import build_graph, find_all_cycles
+import argparse
+import io
+import os
+import pickle
+from bisect import bisect_left
+from collections import defaultdict, deque
+from contextlib import redirect_stdout
+from itertools import islice
+from multiprocessing import Pool
+from test_cases import test_str
+from deadlock_detect_util import WaitForGraph
+from trace_reader_util import read_trace, split_tests
+from placement_util import Placement
+from instruction_util import Op, check_instruction, parse_instructions, format_instruction, transaction_name, var_name
+from commit_log_util import CommitLog, FSYNC_POLICIES
+from output_sink_util import AbortReason, NullSink, TextSink, TeeSink, ResultLogSink, RESULT_FORMATS, make_sink, SINKS
 
 
 class DB:
 
-	def __init__(self):
-		self.tm = self.TM()
+	# placement: which sites hold which variables, see placement_util (default: 10 sites, 20 variables)
+	# sink: where results and debug output go, see output_sink_util (default: text with debug output, on stdout)
+	# log_dir: if set, every site keeps a commit log "site<i>.log" in this directory, see commit_log_util,
+	#	a failed site loses its committed versions and rebuilds them from its log when it recovers,
+	#	sites start with the committed versions of logs already in log_dir (e.g. of a DB before a restart)
+	# fsync: fsync policy of the commit logs, see commit_log_util.FSYNC_POLICIES
+	# truncate_logs: empty the logs already in log_dir instead, the DB starts with the initial values
+	def __init__(self, placement=None, sink=None, log_dir=None, fsync="tick", truncate_logs=False):
+		if placement is None:
+			placement = Placement()
+		if sink is None:
+			sink = TextSink()
+		self.sink = sink
+		self.tm = self.TM(placement, sink, log_dir, fsync, truncate_logs)
+		self.trace_position = None # (test index, instructions executed) in the trace being replayed, saved by checkpoints of run_trace
 		
 	class TM:
 		
@@ -18,145 +44,212 @@ class DB:
 		ABORT = 0
 
 		# initialize TM: start time, end time, is site up array, is read-only array, waiting commands, wait for
-		def __init__(self):
-			self.num_of_sites = 10
-			self.sites = [self.DM(i) for i in range(self.num_of_sites + 1)]
-
-			# TODO: create Transaction class and create a list of transactions
-			# all of the following information should be stored inside the transaction
-			self.curr_time = 0
-			self.start_time = {} # dictionary with key = transaction, value = start time
-			self.end_time = {}
-			self.is_read_only = {} # key: transaction, value: True/False
-			self.waiting = [] # accumulate waiting command
-			self.waits_for = [] # wait-for edges, used for deadlock detection
-			# TODO: change accessed_sites to be a dict of dict: outerkey - transaction innerkey: var value: list of sites a var has accessed
-			self.accessed_sites = defaultdict(list) # key: transaction, value: list of sites a transaction has accessed
-			self.accessed_sites2 = {} # key - transaction value - dict of key - var value - sites it writes to 
-			self.transaction_status = {} # either 1 - commit or 0 - abort
-
-			self.write_to = defaultdict(list) # key: transaction, value: list of variables it writes to
-
+		def __init__(self, placement, sink, log_dir=None, fsync="tick", truncate_logs=False):
+			self.placement = placement
+			self.sink = sink # debug output is only built if sink.verbose
+			self.num_of_sites = placement.num_of_sites
+			self.sites = [None] # sites[0] is unused
+			for i in range(1, self.num_of_sites + 1):
+				commit_log = None
+				if log_dir is not None:
+					commit_log = CommitLog(os.path.join(log_dir, "site%d.log" % i), fsync, truncate=truncate_logs)
+				self.sites.append(self.DM(i, placement, sink, commit_log))
+			self.unsynced_sites = set() # sites whose commit log has records of this tick, synced together when the tick ends
+
+			# time goes on after the last commit found in the logs, so new versions are committed after it
+			self.curr_time = max((site.last_commit_time() for site in self.sites[1:]), default=0)
+			self.batching = False # True while execute_batch runs
+			self.transactions = {} # key: transaction, value: Transaction
+			self.live_read_only = {} # read-only transactions that haven't ended, key: transaction, value: start time (in start order)
+			self.waiting = self.WaitingQueue() # accumulate waiting command, indexed by transaction and by variable
+			self.available_vars = {} # events since last retry: key - variable that became available, value - sites (insertion ordered)
+			self.unblocked_transactions = set() # transactions that stopped waiting for others since last retry
+			self.recovered_sites = set() # sites that recovered or became UP again since last retry, every variable they hold became available
+			self.read_site = {} # key: variable, value: last site that could serve a read of it
+			self.active_at = [set() for i in range(self.num_of_sites + 1)] # indexed by site: transactions that accessed it and haven't committed or aborted yet
+			self.waits_for = WaitForGraph() # wait-for graph, updated as edges are added/removed, used for deadlock detection
+
+			# key: opcode, value: handler taking the op's arguments
+			self.dispatch = {
+				Op.BEGIN: self.on_begin,
+				Op.BEGIN_RO: self.on_begin_ro,
+				Op.READ: self.on_read,
+				Op.WRITE: self.on_write,
+				Op.END: self.on_end,
+				Op.FAIL: self.on_fail,
+				Op.RECOVER: self.on_recover,
+				Op.DUMP: self.on_dump,
+			}
+
+
+
+		# a line that isn't a valid instruction (unknown or with bad arguments) is reported to the sink and skipped
+		def read_in_instruction(self, line):
+			op, error = check_instruction(line)
+			if op is None:
+				# still takes a tick
+				self.curr_time += 1
+				self.sink.error(self.curr_time, line.strip(), *error)
+				return
+			self.execute(op)
 
+		# batch mode on lines, see execute_batch; lines that aren't valid instructions are reported first and don't take a tick
+		def read_in_batch(self, lines):
+			ops, errors = parse_instructions(lines)
+			for line, reason, message in errors:
+				self.sink.error(self.curr_time, line, reason, message)
+			self.execute_batch(ops)
 
-		def read_in_instruction(self, line):
+		# execute a parsed instruction, see instruction_util for the op tuple format
+		def execute(self, op):
 			# increment time
 			self.curr_time += 1
 			# print(self.curr_time)
 
-			# parse instruction
-			l = line.index("(")
-			r = line.index(")")
-			name = line[0:l]
-			args = line[l + 1:r].split(",")
-
-			# get rid of white space of each argument
-			for i in range(len(args)):
-				args[i] = args[i].strip()
-
-			print(name, args)
-			if name == "begin": 
-				assert len(args) == 1
-				self.begin(args[0], self.curr_time)
-			elif name == "beginRO":
-				assert len(args) == 1
-				self.beginRO(args[0], self.curr_time)
-			elif name == "R":
-				assert len(args) == 2
-				self.read(args[0], args[1])
-			elif name == "W":
-				assert len(args) == 3
-
-				# no need to run deadlock detection before write
-				# t_abort = self.deadlock_detect()
-				# print("transaction to be aborted: ", t_abort) # deadlock detectionn happens at the beginning of the tick
-				# if t_abort != None:
-				# 	self.abort(t_abort)
-				# 	self.retry()
-
-				self.write(args[0], args[1], int(args[2]))
-			elif name == "end":
-				assert len(args) == 1
-
-				# deadlock detection
-				to_abort_transactions = self.deadlock_detect()
-				print("transactions to be aborted: ", to_abort_transactions)  # deadlock detectionn happens at the beginning of the tick
+			if self.sink.verbose:
+				self.sink.debug(format_instruction(op))
+			self.dispatch[op[0]](*op[1:])
+
+			# group commit: values committed during the tick reach the logs together
+			if self.unsynced_sites:
+				self.sync_logs()
+
+		def sync_logs(self):
+			for site in self.unsynced_sites:
+				self.sites[site].commit_log.sync()
+			self.unsynced_sites.clear()
+
+		# handlers of the dispatch table, arguments are the ints of the op tuple
+
+		def on_begin(self, t):
+			self.begin(t, self.curr_time)
 
-				if len(to_abort_transaction) > 0:
-					for t_abort in to_abort_transactions:
-						print("transaction to be aborted: ", t_abort)
-						if t_abort != None:
-							print("wait for edges before abort: ", self.waits_for)
-							self.abort(t_abort)
-							print("wait for edges after abort: ", self.waits_for)
+		def on_begin_ro(self, t):
+			self.beginRO(t, self.curr_time)
 
-					# retry after aborting youngest from each cycle
+		def on_read(self, t, x):
+			self.read(t, x)
+
+		def on_write(self, t, x, value):
+			# no need to run deadlock detection before write
+			self.write(t, x, value)
+
+		def on_end(self, t):
+			# in batch mode detection and wakeups are left to the end of the batch,
+			# unless t itself still waits: then its deadlocks and waiting commands have to be settled before it ends
+			if not self.batching or self.waits_for.is_waiting(t) or self.waiting.commands_of(t):
+				self.resolve_deadlocks()
+				if self.batching:
 					self.retry()
 
-				self.end(args[0])
+			self.end(t)
 
-				# retry waiting commands
+			# retry waiting commands
+			if not self.batching:
 				self.retry()
-			elif name == "fail":
-				assert len(args) == 1
-				self.fail(args[0])
-			elif name == "recover":
-				assert len(args) == 1
-				self.recover(args[0])
-			elif name == "dump":
-				self.dump()
-			else:
-				print("Error: unknown command ", name)
 
+		# abort the youngest transaction of every deadlock, then wake up waiting commands
+		def resolve_deadlocks(self):
+			# deadlock detection
+			to_abort_transactions = self.deadlock_detect()
+			if self.sink.verbose:
+				self.sink.debug("transactions to be aborted: ", self.names(to_abort_transactions))  # deadlock detectionn happens at the beginning of the tick
+
+			# aborting the youngest of a component may leave another cycle in it, so detect again until none is left
+			while len(to_abort_transactions) > 0:
+				for t_abort in to_abort_transactions:
+					if self.sink.verbose:
+						self.sink.debug("transaction to be aborted: ", transaction_name(t_abort))
+					if t_abort != None:
+						if self.sink.verbose:
+							self.sink.debug("wait for edges before abort: ", self.named_edges())
+						self.abort(t_abort, AbortReason.DEADLOCK)
+						if self.sink.verbose:
+							self.sink.debug("wait for edges after abort: ", self.named_edges())
+
+				# retry after aborting youngest from each cycle
+				self.retry()
+				to_abort_transactions = self.deadlock_detect()
+
+		# batch mode: execute a list of op tuples, deadlock detection and wakeups of waiting commands run once,
+		# after the last one, instead of at every end
+		# outcomes are the same as one by one execution unless they depend on the order of ops inside the batch
+		# (e.g. a command issued after an end in the same batch that would have woken up a command it conflicts with);
+		# a failure settles the wakeups first (see on_fail), it aborts transactions by the sites they accessed
+		def execute_batch(self, ops):
+			self.batching = True
+			try:
+				for op in ops:
+					self.execute(op)
+			finally:
+				self.batching = False
+			self.resolve_deadlocks()
+			self.retry()
+
+		def on_fail(self, site):
+			# in batch mode, commands woken since the last retry run before the failure, like they would have one by one
+			if self.batching and (self.available_vars or self.unblocked_transactions or self.recovered_sites):
+				self.retry()
+			self.fail(site)
+
+		def on_recover(self, site):
+			self.recover(site)
+
+		def on_dump(self):
+			self.dump()
 
 		def begin(self, transaction, time):
 			# just record its begin time
-			self.start_time[transaction] = time
-			self.is_read_only[transaction] = False
+			self.transactions[transaction] = self.Transaction(time, False)
 
 		def beginRO(self, transaction, time):
-			self.start_time[transaction] = time
-			self.is_read_only[transaction] = True
+			self.transactions[transaction] = self.Transaction(time, True)
+			self.live_read_only[transaction] = time
+
+		# versions committed before this time that have a newer version also committed before it can't be read anymore
+		# it's the start time of the oldest live read-only transaction, or a time after every commit so far if there is none
+		def version_watermark(self):
+			for start in self.live_read_only.values():
+				return start
+			return self.curr_time + 1
 
 		# based on variable, return sites that have its copy
-		# output: a list of site numbers
+		# output: a tuple of site numbers, precomputed by the placement
 		def get_sites_to_access(self, var):
-			site_to_access = []
-			x_idx = int(var[1:])
-			if x_idx % 2 == 1:
-				site_to_access.append(x_idx % 10 + 1)
-			else:
-				for i in range(1, self.num_of_sites + 1):
-					site_to_access.append(i)
-			return site_to_access
-			# print("	site to access: ", site_to_access)
+			return self.placement.sites_of[var]
 
 		# handle write instruction
 		# Output: True - means succeeded, False - means failed, should wait
 		def write(self, transaction, var, value):
-			self.write_to[transaction].append(var)
+			tx = self.transactions[transaction]
 
 			# create a dictionary to remember those sites that a write request writes to
-			if transaction not in self.accessed_sites2:
-				self.accessed_sites2[transaction] = defaultdict(list)
+			if tx.write_sites is None:
+				tx.write_sites = defaultdict(set)
 
 			# distribute it to sites
 			site_to_access = self.get_sites_to_access(var)
 
 			# send write rquest to each site
 			is_waiting = False
+			verbose = self.sink.verbose
 			for site in site_to_access:
-				print("lock table before write: ", self.sites[site].lock_table)
+				if verbose:
+					self.sink.debug("lock table before write: ", self.sites[site].named_lock_table())
 				response = self.sites[site].write(transaction, var, value)
-				print("lock table after write: ", self.sites[site].lock_table)
+				if verbose:
+					self.sink.debug("lock table after write: ", self.sites[site].named_lock_table())
 
 				if response == "success":
-					print("write %s = %d to site %d succeeded" %(var, value, site))
-					self.accessed_sites[transaction].append(site)
-					self.accessed_sites2[transaction][var].append(site)
+					if verbose:
+						self.sink.debug("write %s = %d to site %d succeeded" %(var_name(var), value, site))
+					self.access(transaction, site)
+					tx.write_sites[var].add(site)
 				elif response == "fail":
-					print("site %s is down, unable to write" % site)
+					if verbose:
+						self.sink.debug("site %s is down, unable to write" % site)
 				else:
+					tx.queued_sites.add(site)
 					is_waiting = True
 					break
 					
@@ -167,18 +260,12 @@ class DB:
 				# TODO: release locks
 
 				# because could retry command, so only add different command
-				is_existed = False
-				for command in self.waiting:
-					if command.type == "write" and command.args == [transaction, var, value]:
-						is_existed = True
-						break
-
-				if not is_existed:
-					self.waiting.append(self.Instruction("write", [transaction, var, value]))
-					assert type(response) is list
-					print("%s should wait for %s" % (transaction, response))
-					for t in response:
-						self.waits_for.append((transaction, t)) # first waits for second
+				self.waiting.append(self.Instruction("write", [transaction, var, value]))
+				assert type(response) is list
+				if verbose:
+					self.sink.debug("%s should wait for %s" % (transaction_name(transaction), self.names(response)))
+				for t in response:
+					self.waits_for.add_edge(transaction, t) # first waits for second
 				return False
 
 			return True
@@ -186,242 +273,264 @@ class DB:
 		# TODO: to handle normal read
 		def read(self, transaction, var):
 			# read-only: return committed value on or before the transaction started
-			if self.is_read_only[transaction] == True:
-				assert transaction in self.start_time
-				begin_time = self.start_time[transaction]
+			tx = self.transactions[transaction]
+			if tx.is_read_only == True:
+				begin_time = tx.start_time
 
-				site_to_access = self.get_sites_to_access(var)
-				print("site to access: ", site_to_access)
-				print(begin_time)
+				site = self.find_read_site(var, True)
+				if self.sink.verbose:
+					self.sink.debug("site to access: ", site)
+					self.sink.debug(begin_time)
 
-				for site in site_to_access:
+				if site is not None:
 					result = self.sites[site].read_only(var, begin_time)
-					# print(result)
-
-					if result == "fail":
-						print("site %d is down, cannot read" % site)
-					elif result != None:
-						print("%s: %d" % (var, result))
-						self.accessed_sites[transaction].append(site)
+					if result != None:
+						self.sink.read(transaction, var, result)
+						self.access(transaction, site)
 						return True
 
 				# all sites failed
-				self.waiting.append(Instruction('read_only', [transaction, var]))
+				if self.sink.verbose:
+					self.sink.debug("no site can serve read-only read of %s" % var_name(var))
+				self.waiting.append(self.Instruction('read_only', [transaction, var]))
 				return False
 
 			# normal read
-			# odd vs even variable
-			# odd: read from a site; even: try site one by one, return first 
-			site_to_access = self.get_sites_to_access(var)
+			# odd: read from its site; even: read from any site that can serve it, the last one that could is tried first
+			site = self.find_read_site(var, False)
+			if self.sink.verbose:
+				self.sink.debug("site to access: ", site)
 
-			print("site to access: ", site_to_access)
-			needs_wait = False
-			for site in site_to_access:
+			if site is not None:
 				result = self.sites[site].read(transaction, var)
-				if result != "fail" and type(result) is int:
-					print("%s: %d" % (var, result))
-					self.accessed_sites[transaction].append(site)
+				assert result != "fail"
+				if type(result) is int:
+					self.sink.read(transaction, var, result)
+					self.access(transaction, site)
 					return True
-				if type(result) is list: # return a list of conflicting transactions
-					needs_wait = True
-					break
 
-			# all sites return fail or one of site return list of conflicting transaction, then T must wait
+			# all sites fail or the site returns list of conflicting transaction, then T must wait
 			self.waiting.append(self.Instruction('read', [transaction, var]))
-			if needs_wait == True:
-				assert type(result) is list
-				print("%s should wait for %s" % (transaction, result))
+			if site is not None:
+				assert type(result) is list # return a list of conflicting transactions
+				tx.queued_sites.add(site)
+				if self.sink.verbose:
+					self.sink.debug("%s should wait for %s" % (transaction_name(transaction), self.names(result)))
 				for t in result:
-					self.waits_for.append((transaction, t))
+					self.waits_for.add_edge(transaction, t)
 			return False
 
+		# record that transaction has accessed site
+		def access(self, transaction, site):
+			self.transactions[transaction].accessed_sites.add(site)
+			self.active_at[site].add(transaction)
+
+		# transaction committed or aborted, a failure of the sites it accessed doesn't concern it anymore
+		def deactivate(self, transaction):
+			for site in self.transactions[transaction].accessed_sites:
+				self.active_at[site].discard(transaction)
+
+		# transaction ends or aborts: its snapshot no longer holds back pruning (see version_watermark) and it stops
+		# being active at its sites; nothing may read for it after this, so end and abort call it first
+		def tear_down(self, transaction):
+			self.live_read_only.pop(transaction, None)
+			self.deactivate(transaction)
+
+		# output: a site that can serve a read of var right now, None if there is none
+		# the last site found for var is checked first, other sites are only scanned (in order) when it can't serve anymore
+		def find_read_site(self, var, read_only):
+			site = self.read_site.get(var)
+			if site is not None and self.sites[site].can_read(var, read_only):
+				return site
+			for site in self.get_sites_to_access(var):
+				if self.sites[site].can_read(var, read_only):
+					self.read_site[var] = site
+					return site
+			return None
+
 		def fail(self, site):
 			site = int(site)
 			# erase lock table + curr_vals?
 			self.sites[site].fail()
 		
 			# check if a transactionn has accessed this site, if so, abort it right away
-			for t in self.accessed_sites:
-				if site in self.accessed_sites[t]:
-					self.abort(t)
-					# self.transaction_status[t] = self.ABORT
-					# TODO: should revert all commands
+			# only active transactions are looked at, finished ones are already out of the index; in begin order
+			for t in sorted(self.active_at[site], key=lambda t: self.transactions[t].start_time):
+				self.abort(t, AbortReason.SITE_FAILURE)
 
 		def recover(self, site):
-			self.sites[int(site)].recover()
+			site = int(site)
+			self.sites[site].recover(self.version_watermark())
+			self.recovered_sites.add(site)
 
 		def release_locks(self, t):
-			for i in self.accessed_sites[t]:
-				self.sites[i].release_locks(t)
+			tx = self.transactions[t]
+			for i in tx.accessed_sites | tx.queued_sites:
+				for var in self.sites[i].release_locks(t):
+					self.add_available_var(var, i)
+
+		# record event: variable var became available at site
+		def add_available_var(self, var, site):
+			if var not in self.available_vars:
+				self.available_vars[var] = set()
+			self.available_vars[var].add(site)
 
 		# print commit or abort
 		def end(self, t):
+			tx = self.transactions[t]
+			tx.end_time = self.curr_time
+			self.tear_down(t)
 			# release locks
 			self.release_locks(t)
+			# delete its waiting commands, whether it commits or aborts they must not run after it ended
+			self.waiting.remove_transaction(t)
 
 			# check if all sites t has accessed can commit, which means assign curr_vals to commit_vals
 			# (may not need to do this since we already abort the transaction in fail instruction)
-			if t in self.transaction_status and self.transaction_status[t] == self.ABORT: # already aborted
-				print("%s aborts" % t)
-				# delete its waiting command
-				for c in self.waiting:
-					if c.args[0] == t:
-						self.waiting.remove(c)
+			if tx.status == self.ABORT: # already aborted
+				self.sink.abort(t, tx.abort_reason)
 				return
 			
-			self.transaction_status[t] = self.COMMIT # commit
-			print("%s commits" % t)
+			tx.status = self.COMMIT # commit
+			self.sink.commit(t)
 
 			# commit values: assign curr_vals to commit_vals
 			self.commit_values(t)
 
 			# updates waits-for edges: delete any edge that has other transactions wait for this transaction
 			# Assumption: this transaction shouldnn't wait for any other transaction when it commits
-			for edge in self.waits_for.copy():
-				assert edge[0] != t
-				if edge[1] == t:
-					self.waits_for.remove(edge)
+			assert not self.waits_for.is_waiting(t)
+			self.unblocked_transactions.update(self.waits_for.remove_edges_to(t))
 
 		# commit values that transaction has written to
 		def commit_values(self, transaction):
 			# site_to_access = set()
-			var_been_written = self.write_to[transaction]
+			watermark = self.version_watermark()
+			# each variable once, even if the write was retried
+			var_been_written = self.transactions[transaction].write_sites or {}
 
 			for var in var_been_written:
 				# sites_to_commit = self.get_sites_to_access(var)
-				sites_to_commit = self.accessed_sites2[transaction][var]
+				sites_to_commit = var_been_written[var]
 
 				# filter out those sites that weren't accessed by this transaction
 				# for site in sites_to_commit.copy():
-				# 	if site not in self.accessed_sites[transaction]:
+				# 	if site not in accessed_sites:
 				# 		sites_to_commit.remove(site)
 				# print("   sites to commit: ", sites_to_commit)
 				for site in sites_to_commit:
-					self.sites[site].commit_value(var, self.curr_time)
+					if self.sites[site].commit_value(var, self.curr_time, watermark):
+						# read-only reads wait for the site to be UP, wake them up like a recovery does
+						self.recovered_sites.add(site)
+					if self.sites[site].commit_log is not None:
+						self.unsynced_sites.add(site)
 
 
 		def dump(self):
 			for i in range(1, self.num_of_sites + 1):
-				print("site %d" % i, end = " - ")
-				self.sites[i].print_commit_vals()
+				self.sink.dump(i, self.sites[i].committed_values())
 
 
 
-		# function: retry waiting commands recursivly
-		# when to use: when lock table is changed (locks are released or erased), 
+		# function: wake up waiting commands
+		# when to use: when lock table is changed (locks are released or erased) or a site recovers
+		# only commands queued on a variable that became available, or commands of a transaction that no longer
+		# waits for anyone, are tried; each of them once, in queue order
 		def retry(self):
-			print("waiting command: ", self.waiting)
-			if len(self.waiting) == 0:
+			verbose = self.sink.verbose
+			if verbose:
+				self.sink.debug("waiting command: ", self.waiting)
+			woken = {}
+			for var in self.available_vars:
+				for command in self.waiting.commands_on(var):
+					woken[command.key()] = command
+			# a recovered (or UP again) site wakes up commands on its variables, only variables with waiting commands are looked at
+			for site in self.recovered_sites:
+				for var in list(self.waiting.by_var):
+					if self.placement.replicated[var] or self.placement.sites_of[var][0] == site:
+						for command in self.waiting.commands_on(var):
+							woken[command.key()] = command
+			self.recovered_sites.clear()
+			for t in self.unblocked_transactions:
+				for command in self.waiting.commands_of(t):
+					woken[command.key()] = command
+			self.available_vars.clear()
+			self.unblocked_transactions.clear()
+			if not woken:
 				return
 
-			# determine which transaction's commands to try first: the one that doesn't wait for anyone
-			print("    waits for: ", self.waits_for)
-			# adjlist = defaultdict(list)
-			# for edge in self.waits_for:
-			# 	adjlist[edge[0]].append(edge[1])
-			# 	adjlist[edge[1]] = []
-
-			# transactions_to_try = []
-			# for key in adjlist:
-			# 	if not adjlist[key]: # empty
-			# 		transactions_to_try.append(key)
-			# print("transactions to try: ", transactions_to_try)
-
-			# commands_to_try = []
-			# if not transactions_to_try: # only left with transactions that aren't waiting for any
-			# 	commands_to_try = self.waiting
-			# else:
-			# 	for command in self.waiting:
-			# 		if command.args[0] in transactions_to_try:
-			# 			commands_to_try.append(command)
-
-			# print("commands to try: ", commands_to_try)
-
-			# select from waiting command, find which doesn't wait for anything
+			if verbose:
+				self.sink.debug("    waits for: ", self.named_edges())
+
+			# select from woken commands those whose transaction doesn't wait for anything
 			commands_to_try = []
-			for command in self.waiting:
-				is_waiting = False
-				for edge in self.waits_for:
-					if command.args[0] == edge[0]: # this command's transaction is waiting for other transaction
-						is_waiting = True
-						break
-				if is_waiting == False:
+			for command in sorted(woken.values(), key=lambda c: c.seq):
+				if not self.waits_for.is_waiting(command.args[0]): # this command's transaction isn't waiting for other transaction
 					commands_to_try.append(command)
-			print("    commands to try: ", commands_to_try)
+			if verbose:
+				self.sink.debug("    commands to try: ", commands_to_try)
 
 			for command in commands_to_try:
-				print("retry %s" % command)
+				if verbose:
+					self.sink.debug("retry %s" % command)
 				if command.type == "write":
 					assert len(command.args) == 3
 					result = self.write(command.args[0], command.args[1], command.args[2])
-					print("retry result: ", result)
-					if result == True:
-						# update waiting command
-						self.waiting.remove(command)
-						# retry next command
-						self.retry()
-					return
 				elif command.type == "read":
 					assert len(command.args) == 2
 					result = self.read(command.args[0], command.args[1])
-					if result == True:
-						self.waiting.remove(command)
-						self.retry()
+				elif command.type == "read_only":
+					assert len(command.args) == 2
+					result = self.read(command.args[0], command.args[1])
+				if verbose:
+					self.sink.debug("retry result: ", result)
+				if result == True:
+					# update waiting command
+					self.waiting.remove(command)
 
 		def revert_to_last_commit_val(self, transaction):
-			for site in self.accessed_sites[transaction]:
+			for site in self.transactions[transaction].accessed_sites:
 				self.sites[site].revert_to_last_commit_value(transaction)
 
 		# Description: abort a transaction, release all locks it's holding, remove its waiting commands, and remove related waits-for edge
-		def abort(self, transaction):
+		# reason: AbortReason, reported when the transaction ends
+		def abort(self, transaction, reason=AbortReason.UNKNOWN):
+			self.tear_down(transaction)
 			# revert back to last commit value
 			self.revert_to_last_commit_val(transaction)
 			# release locks
 			self.release_locks(transaction) 
 
 			# remove its waiting command
-			for command in self.waiting:
-				if command.args[0] == transaction:
-					self.waiting.remove(command)
+			self.waiting.remove_transaction(transaction)
 
 			# remove related waits-for edges
-			for edge in self.waits_for.copy(): # when deleting elements in the list during the loop, size could change, so use copy
-				if edge[0] == transaction or edge[1] == transaction:
-					self.waits_for.remove(edge)
+			self.unblocked_transactions.update(self.waits_for.remove_node(transaction))
+			self.unblocked_transactions.discard(transaction)
 
-			self.transaction_status[transaction] = self.ABORT # 0 means abort
-
-		def _youngest_transaction_from_ids(self, transaction_numbers):
-			transactions_named = ['T'+str(x) for x in transaction_numbers]
-			ts_w_start_times = [(t_id, self.start_time[t_id]) for t_id in transactions_named]
-			sorted_ts = sorted(ts_w_start_times, key=lambda x: x[1], reverse=True)
-			youngest = sorted_ts[0][0]
-			return youngest
+			self.transactions[transaction].status = self.ABORT # 0 means abort
+			self.transactions[transaction].abort_reason = reason
 
 		# Detect if there is a deadlock
-		# input: a list of wait-for edges
-		# output: transaction to be aborted
+		# only components reachable from cycles closed since the last detection are searched, see WaitForGraph
+		# output: transactions to be aborted, the youngest of each deadlocked strongly connected component
 		def deadlock_detect(self):
-			# construct adjlist 
-			graph = defaultdict(list)
-			for edge in self.waits_for:
-				node1 = int(edge[0][1:])
-				node2 = int(edge[1][1:])
-				graph[node1].append(node2) # only use transaction's number
-
-			print("graph:", graph)
-			found_cycles = find_all_cycles(graph)
-			# found_cycles is a list of lists; kill youngest from each cycle (each sublist)
-			youngest_from_each_cycle = []
-			for cycle in found_cycles:
-				youngest_in_cycle = self._youngest_transaction_from_ids(cycle)
-				youngest_from_each_cycle.append(youngest_in_cycle)
-			return youngest_from_each_cycle
+			if self.sink.verbose:
+				self.sink.debug("graph:", self.named_edges())
+			deadlocks = self.waits_for.pop_deadlocks(victim_key=lambda t: self.transactions[t].start_time)
+			return [youngest for scc, youngest in deadlocks]
+
+
+		# names of a list of transactions, for printing
+		def names(self, transactions):
+			return [transaction_name(t) for t in transactions]
 
+		def named_edges(self):
+			return [(transaction_name(start), transaction_name(end)) for start, end in self.waits_for.edges()]
 
 		def print_state(self):
-			print("start time: ", self.start_time)
-			print("is read only: ", self.is_read_only)
+			print("start time: ", {transaction_name(t): tx.start_time for t, tx in self.transactions.items()})
+			print("is read only: ", {transaction_name(t): tx.is_read_only for t, tx in self.transactions.items()})
 			print("waiting instruction: ", self.waiting)
 
 			print("Sites:")
@@ -432,16 +541,103 @@ class DB:
 	
 
 		# inner class of TM
+		# everything the TM knows about one transaction
+		class Transaction:
+			__slots__ = ("start_time", "is_read_only", "accessed_sites", "queued_sites", "write_sites", "status", "abort_reason", "end_time")
+
+			def __init__(self, start_time, is_read_only):
+				self.start_time = start_time
+				self.is_read_only = is_read_only
+				self.accessed_sites = set() # sites the transaction has accessed
+				self.queued_sites = set() # sites where the transaction queued a lock request (may be granted later)
+				self.write_sites = None # key - var value - set of sites it writes to, created on first write
+				self.status = None # COMMIT or ABORT once it's finished
+				self.abort_reason = None # AbortReason if it's aborted
+				self.end_time = None
+
+		# checkpoints (DB.checkpoint) don't include the sink, DB.restore attaches one
+		def __getstate__(self):
+			state = self.__dict__.copy()
+			del state["sink"]
+			return state
+
+		def __setstate__(self, state):
+			self.__dict__.update(state)
+			self.sink = NullSink()
+
 		class Instruction:
+			__slots__ = ("type", "args", "seq")
+
 			def __init__(self, type, args):
 				self.type = type
 				self.args = args
+				self.seq = 0 # position in the waiting queue, set by WaitingQueue.append
 
 			def __repr__(self):
-				return "%s(%s)" % (self.type, self.args)
+				return "%s(%s)" % (self.type, self.named_args())
 
 			def __str__(self):
-				return "%s(%s)" % (self.type, self.args)
+				return "%s(%s)" % (self.type, self.named_args())
+
+			# args are [transaction, var, ...]
+			def named_args(self):
+				return [transaction_name(self.args[0]), var_name(self.args[1])] + self.args[2:]
+
+			# identifies the command in the waiting queue, the same command is only queued once
+			def key(self):
+				return (self.type, tuple(self.args))
+
+		# FIFO queue of waiting commands with O(1) lookup by transaction, by variable and by command
+		# every index is an insertion ordered dict, so each of them keeps FIFO order on its own
+		class WaitingQueue:
+			def __init__(self):
+				self.commands = {} # key: Instruction.key(), value: Instruction
+				self.by_transaction = defaultdict(dict) # key: transaction, value: dict of Instruction.key() -> Instruction
+				self.by_var = defaultdict(dict) # key: variable, value: dict of Instruction.key() -> Instruction
+				self.next_seq = 0
+
+			# Output: True - command added, False - same command already waiting
+			def append(self, command):
+				key = command.key()
+				if key in self.commands:
+					return False
+				command.seq = self.next_seq
+				self.next_seq += 1
+				self.commands[key] = command
+				self.by_transaction[command.args[0]][key] = command
+				self.by_var[command.args[1]][key] = command
+				return True
+
+			def remove(self, command):
+				key = command.key()
+				if self.commands.pop(key, None) is None:
+					return
+				transaction, var = command.args[0], command.args[1]
+				self.by_transaction[transaction].pop(key)
+				if not self.by_transaction[transaction]:
+					del self.by_transaction[transaction]
+				self.by_var[var].pop(key)
+				if not self.by_var[var]:
+					del self.by_var[var]
+
+			def remove_transaction(self, transaction):
+				for command in self.commands_of(transaction):
+					self.remove(command)
+
+			# commands of a transaction in FIFO order
+			def commands_of(self, transaction):
+				return list(self.by_transaction.get(transaction, {}).values())
+
+			# commands on a variable in FIFO order
+			def commands_on(self, var):
+				return list(self.by_var.get(var, {}).values())
+
+			# iterate over a snapshot, so the queue can be changed during the loop
+			def __iter__(self):
+				return iter(list(self.commands.values()))
+
+			def __repr__(self):
+				return "%s" % list(self.commands.values())
 
 		class DM:
 
@@ -452,59 +648,244 @@ class DB:
 			UP = 1
 			RECOVER = 2
 
-			# TODO: creat lock class and acqure and release method
+			NO_LOCK = -1
+			SHARED = -1 # lock_holder value of a read lock held by more than one transaction
+
+			# a lock request waiting in waiting_list
 			class LOCK:
+				__slots__ = ("type", "transaction")
+
 				def __init__(self, type, transaction):
 					self.type = type
-					self.transactions = set() # set: transactions holding the lock
+					self.transaction = transaction
 
-					self.transactions.add(transaction)
+				def holds(self, transaction):
+					return transaction == self.transaction
 
-				# def acqure(self, transaction):
-				# 	if self.type == WLOCK:
-				# 		if not self.transactions:
-				# 			self.transactions.add(transaction)
-				# 			return True
-				# 		return False
-				# 	elif self.type == RLOCK:
 				def __repr__(self):
-					return "%s(%s)" % (self.type, self.transactions)
+					return "%s({'%s'})" % (self.type, transaction_name(self.transaction))
 
 				def __str__(self):
-					return "%s(%s)" % (self.type, self.transactions)
+					return self.__repr__()
+
+			# committed versions of a variable, sorted by commit time
+			# kept as parallel lists so a snapshot read is a binary search over commit times
+			class VersionChain:
+				def __init__(self):
+					self.times = []
+					self.values = []
+
+				# commit times are increasing, so a new version always goes to the end
+				def add(self, value, time):
+					self.times.append(time)
+					self.values.append(value)
+
+				def last_value(self):
+					return self.values[-1]
+
+				# Output: value of the last version committed before time, None if there is none
+				def value_before(self, time):
+					i = bisect_left(self.times, time)
+					if i == 0:
+						return None
+					return self.values[i - 1]
+
+				# drop every version older than the newest version committed before watermark
+				def prune(self, watermark):
+					i = bisect_left(self.times, watermark) - 1
+					if i > 0:
+						del self.times[:i]
+						del self.values[:i]
+
+				def __len__(self):
+					return len(self.times)
+
+				def __repr__(self):
+					return "%s" % list(zip(self.values, self.times))
 
-			def __init__(self, site_no):
+			# commit_log: CommitLog of the site, None if committed versions only live in memory
+			def __init__(self, site_no, placement, sink, commit_log=None):
 				self.number = site_no
+				self.placement = placement
+				self.sink = sink
+				self.commit_log = commit_log
 				self.status = self.UP
-				self.num_of_var = 20
-				self.curr_vals = {} # is a map: has key means try to write to it, when site is down, erase its value but leave the key. 
-				self.commit_vals = defaultdict(list)  # dictionary of list(sorted by time) - key: variable ("x1") value: a list of pairs of val and commit time 
-				self.lock_table = {} # key: variable ("x1") value: lock(type, transaction) 0 - read lock 1 - write lock, (todo: shared lock)
-				self.waiting_list = defaultdict(list) # waiting to acquire locks on var: key - var, value - list of Lock(type, transactionn)
-				self.is_just_recovered = {} # key - var, value - true/false (used only for even variables)
-
-				# initialize commit_vals, curr_vals, and is_recovered
-				for i in range(1, self.num_of_var + 1):
-					if i % 2 == 0 or i % 10 + 1 == self.number:
-						var = "x" + str(i)
-						self.commit_vals[var].append((i * 10, 0))
-						self.curr_vals[var] = i * 10
-
-						if i % 2 == 0:
-							self.is_just_recovered[var] = False
+
+				# sparse tables keyed by variable id (1 for "x1"), only variables touched at this site have an entry,
+				# the others still have the initial value of placement.initial_values (committed at time 0), shared by all sites
+				self.curr_vals = {} # key: var, value: value written but not committed yet
+				self.commit_vals = {}  # key: var, value: VersionChain of committed values sorted by commit time, created on first commit
+				self.lock_mode = {} # key: var, value: RLOCK (0) or WLOCK (1), no entry means NO_LOCK
+				self.lock_holder = {} # key: var, value: transaction holding the lock, SHARED if more than one
+				self.shared_holders = {} # key - var, value - set of transactions sharing a read lock (only for SHARED)
+				self.waiting_list = {} # key: var, value: deque of LOCK(type, transaction) waiting to acquire locks on var, head first
+				self.locks_held = defaultdict(set) # key - transaction, value - set of variables it holds a lock on
+				self.requests_of = defaultdict(set) # key - transaction, value - set of variables it has a request queued on
+				# a replicated var is unreadable after a recovery until it has a commit: instead of a flag per variable,
+				# recoveries are numbered and each variable remembers the number of the recovery of its last commit
+				self.recovery_no = 0 # recoveries so far
+				self.committed_since = {} # key - var, value - recovery_no at its last commit, no entry means 0
+				self.num_of_unreadable = 0 # replicated variables without a commit since the last recovery
+				if commit_log is not None and commit_log.num_of_records > 0: # restart: the log has the committed versions
+					self.commit_vals = self.replay_commit_log(None)
+
+			def __getstate__(self):
+				state = self.__dict__.copy()
+				del state["sink"]
+				return state
+
+			def __setstate__(self, state):
+				self.__dict__.update(state)
+				self.sink = NullSink()
 
 			def fail(self):
 				self.status = self.DOWN
-				self.lock_table.clear()
+				# uncommitted values are lost, their transactions are aborted
+				self.curr_vals.clear()
+				if self.commit_log is not None: # committed versions are in the log
+					self.commit_vals = {}
+				self.lock_mode.clear()
+				self.lock_holder.clear()
+				self.shared_holders.clear()
 				self.waiting_list.clear()
+				self.locks_held.clear()
+				self.requests_of.clear()
 
-			def recover(self):
+			# every replicated variable becomes unreadable until its next commit, O(1)
+			# with a commit log, committed versions are rebuilt from it first, keeping those a reader may still need (see prune)
+			def recover(self, watermark=None):
 				self.status = self.RECOVER
-
-				for var in self.is_just_recovered:
-					self.is_just_recovered[var] = True
-
-
+				self.recovery_no += 1
+				self.num_of_unreadable = len(self.placement.replicated_vars)
+				if self.commit_log is not None:
+					self.commit_vals = self.replay_commit_log(watermark)
+
+			# output: commit_vals rebuilt from the commit log
+			def replay_commit_log(self, watermark):
+				commit_vals = {}
+				for var, value, time in self.commit_log.replay():
+					versions = commit_vals.get(var)
+					if versions is None:
+						versions = commit_vals[var] = self.VersionChain()
+						versions.add(self.placement.initial_values[var], 0)
+					versions.add(value, time)
+				if watermark is not None:
+					for versions in commit_vals.values():
+						versions.prune(watermark)
+				return commit_vals
+
+			# commit time of the last committed version at this site, 0 if there is none
+			def last_commit_time(self):
+				return max((versions.times[-1] for versions in self.commit_vals.values()), default=0)
+
+			# True if var is replicated and has no commit since the site recovered
+			def is_just_recovered(self, var):
+				return self.placement.replicated[var] and self.committed_since.get(var, 0) != self.recovery_no
+
+			# value of the last commit of var at this site
+			def last_commit_value(self, var):
+				versions = self.commit_vals.get(var)
+				if versions is None:
+					return self.placement.initial_values[var]
+				return versions.last_value()
+
+			# value a transaction holding a lock on var sees
+			def curr_value(self, var):
+				if var in self.curr_vals:
+					return self.curr_vals[var]
+				return self.last_commit_value(var)
+
+			# lock table access, the lock on var is (lock_mode[var], holders), only locked variables have an entry
+
+			def holds_lock(self, var, transaction):
+				holder = self.lock_holder[var]
+				if holder == self.SHARED:
+					return transaction in self.shared_holders[var]
+				return holder == transaction
+
+			def lock_holders(self, var):
+				holder = self.lock_holder[var]
+				if holder == self.SHARED:
+					return self.shared_holders[var]
+				return (holder,)
+
+			def num_of_lock_holders(self, var):
+				if self.lock_holder[var] == self.SHARED:
+					return len(self.shared_holders[var])
+				return 1
+
+			# var must not be locked
+			def acquire_lock(self, var, type, transaction):
+				self.lock_mode[var] = type
+				self.lock_holder[var] = transaction
+				self.locks_held[transaction].add(var)
+
+			# share the read lock on var with transaction
+			def share_lock(self, var, transaction):
+				holder = self.lock_holder[var]
+				if holder != self.SHARED:
+					self.shared_holders[var] = set([holder])
+					self.lock_holder[var] = self.SHARED
+				self.shared_holders[var].add(transaction)
+				self.locks_held[transaction].add(var)
+
+			# Output: True if no transaction holds the lock on var anymore
+			def unlock(self, var, transaction):
+				if self.lock_holder[var] == self.SHARED:
+					holders = self.shared_holders[var]
+					holders.discard(transaction)
+					if len(holders) == 1:
+						self.lock_holder[var] = holders.pop()
+						del self.shared_holders[var]
+					return False
+				del self.lock_mode[var]
+				del self.lock_holder[var]
+				return True
+
+			# queue a lock request of transaction on var, FIFO
+			# a transaction has at most one request per variable: asking again keeps its place, a write request
+			# turns its queued read request into a write request
+			def enqueue(self, var, type, transaction):
+				waiting = self.waiting_list.get(var)
+				if waiting is None:
+					waiting = self.waiting_list[var] = deque()
+				if var in self.requests_of.get(transaction, ()):
+					for lock in waiting:
+						if lock.transaction == transaction:
+							if type == self.WLOCK:
+								lock.type = self.WLOCK
+							return
+				waiting.append(self.LOCK(type, transaction))
+				self.requests_of[transaction].add(var)
+
+			def dequeue_head(self, var):
+				waiting = self.waiting_list[var]
+				lock = waiting.popleft()
+				if not waiting:
+					del self.waiting_list[var]
+				self.requests_of[lock.transaction].discard(var)
+				return lock
+
+			# grant queued requests on var in FIFO order while they are compatible with the lock on var
+			# read requests at the head are granted together; a write request is granted when nobody else holds the lock
+			def grant_waiting(self, var):
+				waiting = self.waiting_list.get(var)
+				while waiting:
+					head = waiting[0]
+					mode = self.lock_mode.get(var, self.NO_LOCK)
+					if mode == self.NO_LOCK:
+						self.dequeue_head(var)
+						self.acquire_lock(var, head.type, head.transaction)
+					elif self.holds_lock(var, head.transaction) and self.num_of_lock_holders(var) == 1:
+						# the only holder asks again, e.g. promote its read lock
+						self.dequeue_head(var)
+						if head.type == self.WLOCK:
+							self.lock_mode[var] = self.WLOCK
+					elif mode == self.RLOCK and head.type == self.RLOCK:
+						self.dequeue_head(var)
+						self.share_lock(var, head.transaction)
+					else:
+						return
 
 			# handle write request
 			# TODO: change site's status from recover to up after a successful write
@@ -514,209 +895,215 @@ class DB:
 				if self.status == self.DOWN:
 					return "fail"
 
-				if x in self.lock_table:
+				if x in self.lock_mode:
 					# if it's the same transaction and hold a write lock, then can proceed
 					# else return the conflicting transaction
-					if transaction in self.lock_table[x].transactions: # lock held by same transaction
-						if self.lock_table[x].type == self.WLOCK: # hold a write lock already
+					waiting = self.waiting_list.get(x)
+					if self.holds_lock(x, transaction): # lock held by same transaction
+						if self.lock_mode[x] == self.WLOCK: # hold a write lock already
 							self.curr_vals[x] = val
 							return "success"
 						# hold a read lock
-						print("    waiting list:", self.waiting_list[x])
-						if len(self.lock_table[x].transactions) == 1: # not a shared read lock
-							if not self.waiting_list[x]: # no other waiting
-								self.lock_table[x].type = self.WLOCK
+						if self.sink.verbose:
+							self.sink.debug("    waiting list:", waiting)
+						if self.num_of_lock_holders(x) == 1: # not a shared read lock
+							if not waiting: # no other waiting
+								self.lock_mode[x] = self.WLOCK
 								self.curr_vals[x] = val
 								return "success"
 
 							# there is waiting locks
 
 							# if current transaction is the first one in the waiting queue -> promote RLOCK to WLOCK and delete from waiting list
-							if self.waiting_list[x][0].type == self.WLOCK and transaction in self.waiting_list[x][0].transactions:
-								self.waiting_list[x].pop(0) # remove it from the waiting list
-								self.lock_table[x].type = self.WLOCK
+							if waiting[0].type == self.WLOCK and waiting[0].holds(transaction):
+								self.dequeue_head(x) # remove it from the waiting list
+								self.lock_mode[x] = self.WLOCK
 								self.curr_vals[x] = val
 								return "success"
 
-						if not self.waiting_list[x] and len(self.lock_table[x].transactions) == 1: # not a shared lock
-							# promote lock and proceed
-							self.lock_table[x].type = self.WLOCK
-							self.curr_vals[x] = val
-							return "success"
-
 						# there are waiting locks and/or a shared read lock -> need to wait
 
 						conflict_transactions = []
 						# infer conflict from waiting list
-						conflict_transactions.extend(self.infer_conflicts_from_waiting_locks(x))
+						conflict_transactions.extend(self.infer_conflicts_from_waiting_locks(x, transaction))
 
 						# infer conflict from shared read lock
-						for t in self.lock_table[x].transactions:
+						for t in self.lock_holders(x):
 							if t != transaction:
 								conflict_transactions.append(t)
 						# print("%s must waits for %s" % (transaction, conflict_transactions))
 
-						self.waiting_list[x].append(self.LOCK(self.WLOCK, transaction))
+						self.enqueue(x, self.WLOCK, transaction)
 
 						return conflict_transactions
 
 					# other transactions holding a lock on x
 					# infer conflict from waiting list
-					conflict_transactions = self.infer_conflicts_from_waiting_locks(x)
-					conflict_transactions.extend(self.lock_table[x].transactions)
+					conflict_transactions = self.infer_conflicts_from_waiting_locks(x, transaction)
+					conflict_transactions.extend(self.lock_holders(x))
 					# print("%s must waits for %s" % (transaction, conflict_transactions))
 
-					self.waiting_list[x].append(self.LOCK(self.WLOCK, transaction))
+					self.enqueue(x, self.WLOCK, transaction)
 					# print("lock waiting list: ", self.waiting_list)
 
 					return conflict_transactions # transaction that holds the lock
 
 				# no lock on x
-				self.lock_table[x] = self.LOCK(self.WLOCK, transaction)
+				self.acquire_lock(x, self.WLOCK, transaction)
 				self.curr_vals[x] = val
 				return "success"
 
-			def infer_conflicts_from_waiting_locks(self, var):
+			# transactions queued on var ahead of transaction (all of them if it isn't queued yet)
+			def infer_conflicts_from_waiting_locks(self, var, transaction):
 				conflict_transactions = []
-				for lock in self.waiting_list[var]:
-					conflict_transactions.extend(lock.transactions)
+				for lock in self.waiting_list.get(var, ()):
+					if lock.transaction == transaction:
+						break
+					conflict_transactions.append(lock.transaction)
 				return conflict_transactions
 
 			# Output: "fail" - site is down or just recovered, value - if succeeded (guranteed to return one)
 			def read_only(self, var, begin_time):
-				if self.status == self.DOWN or self.status == self.RECOVER:
+				if not self.can_read(var, True):
 					return "fail"
 
-				history = self.commit_vals[var]
-				print("history: ", history)
-
-				# return the lastest val: last val in the list whose commit time is < begin_time
-				for i in range(len(history)):
-					if history[i][1] < begin_time:
-						if i == len(history) - 1 or history[i + 1][1] > begin_time:
-							return history[i][0]
+				# return the lastest val: last version whose commit time is < begin_time
+				versions = self.commit_vals.get(var)
+				if versions is None: # never committed here, initial value committed at time 0
+					return self.placement.initial_values[var]
+				return versions.value_before(begin_time)
 
 			# handle recover cases
 			# Output: "fail" - site is down or var just recovered, value - if succeeded, or list of conflicting transactions
 			def read(self, transaction, var):
-				if self.status == self.DOWN:
+				if not self.can_read(var, False):
 					return "fail"
+				return self.read_helper(transaction, var)
 
-				if self.status == self.RECOVER:
-					x_idx = int(var[1:])
-					if x_idx % 2 == 1: # odd variable(unreplicated) can be read directly
-						return self.read_helper(transaction, var)
-					
-					if self.is_just_recovered[var] == True:
-						return "fail"
-
-					return self.read_helper(transaction, var)
+			# Output: True if this site can serve a read of var, False if it is down or var just recovered
+			# read-only reads need the site to be up
+			def can_read(self, var, read_only):
+				if self.status == self.UP:
+					return True
+				if self.status == self.DOWN or read_only:
+					return False
 
-				return self.read_helper(transaction, var)
+				# recovering
+				if not self.placement.replicated[var]: # unreplicated variable can be read directly
+					return True
+				return self.committed_since.get(var, 0) == self.recovery_no
 
 
 			def read_helper(self, transaction, var):
-				if var not in self.lock_table: # no lock on var -> acqure RLOCK
-					self.lock_table[var] = (self.LOCK(self.RLOCK, transaction))
-
-					# TODO: curr_val don't have this key
-					return self.curr_vals[var]
+				if var not in self.lock_mode: # no lock on var -> acqure RLOCK
+					self.acquire_lock(var, self.RLOCK, transaction)
+					return self.curr_value(var)
 
 				conflict_transactions = []
 
 				# there is a lock on var
-				if self.lock_table[var].type == self.WLOCK:
+				if self.lock_mode[var] == self.WLOCK:
 					# check if it's same transaction, if so proceed
-					if transaction in self.lock_table[var].transactions:
-						return self.curr_vals[var]
+					if self.holds_lock(var, transaction):
+						return self.curr_value(var)
 					# write lock on var held by different transaction
-					conflict_transactions.extend(self.lock_table[var].transactions)
-					self.waiting_list[var].append(self.LOCK(self.RLOCK, transaction))
+					conflict_transactions.extend(self.lock_holders(var))
+					self.enqueue(var, self.RLOCK, transaction)
 					
 					# TODO: Q: iterate through all waiting lock and figure out conflicts?
 					return conflict_transactions # return the conflicting transaction
 
 				# there is a read lock on var
-				if transaction in self.lock_table[var].transactions: # already held the read lock
-					return self.curr_vals[var]
+				if self.holds_lock(var, transaction): # already held the read lock
+					return self.curr_value(var)
 
 				# read lock held by others
-				if not self.waiting_list[var]: # no waiting locks
-					self.lock_table[var].transactions.add(transaction) # acquire shared read lock on var
-					return self.curr_vals[var]
+				if var not in self.waiting_list: # no waiting locks
+					self.share_lock(var, transaction) # acquire shared read lock on var
+					return self.curr_value(var)
 
 				# there are waiting locks
-				self.waiting_list[var].append(self.LOCK(self.RLOCK, transaction))
-				conflict_transactions.extend(self.lock_table[var].transactions)
+				self.enqueue(var, self.RLOCK, transaction)
+				conflict_transactions.extend(self.lock_holders(var))
 				# Q: do i need to lock all waiting locks to add conflicts?
 
 				return conflict_transactions
 
 			
+			# lock table as a dict, only for printing: key - variable name, value - "type({holders})"
+			def named_lock_table(self):
+				locked_vars = set()
+				for vars in self.locks_held.values():
+					locked_vars.update(vars)
+				return {var_name(x): "%d(%s)" % (self.lock_mode[x], [transaction_name(t) for t in sorted(self.lock_holders(x))]) for x in sorted(locked_vars)}
+
 			def print_state(self):
 				print("    status: ", self.status)
-				print("    curr_vals: ", self.curr_vals)
+				print("    curr_vals: ", {var_name(x): self.curr_value(x) for x in self.placement.vars_at(self.number)})
 				# print("	   commit values: ", self.commit_vals)
-				print("    lock table: ", self.lock_table)
-				print("    is just recovered: ", self.is_just_recovered)
+				print("    lock table: ", self.named_lock_table())
+				print("    is just recovered: ", {var_name(x): self.is_just_recovered(x) for x in self.placement.vars_at(self.number) if self.placement.replicated[x]})
 
 
+			# release the locks of transaction and drop its queued requests, then grant waiting requests on those variables
+			# Output: list of variables whose lock was released, i.e. events "var became available at this site"
 			def release_locks(self, transaction):
-				# release locks
-				for var, lock in self.lock_table.copy().items():
-					if transaction in lock.transactions:
-						self.lock_table[var].transactions.remove(transaction)
-						if not self.lock_table[var].transactions: # empty
-							self.lock_table.pop(var)
-				# todo: update waiting_list
+				released = []
+				for var in self.locks_held.pop(transaction, ()):
+					self.unlock(var, transaction)
+					released.append(var)
+				for var in self.requests_of.pop(transaction, ()):
+					waiting = self.waiting_list[var]
+					for lock in waiting:
+						if lock.transaction == transaction:
+							waiting.remove(lock)
+							break
+					if not waiting:
+						del self.waiting_list[var]
+					released.append(var)
+				released = list(dict.fromkeys(released))
+				for var in released:
+					self.grant_waiting(var)
+				return released
 
 
 			def revert_to_last_commit_value(self, transaction):
-				for var, lock in self.lock_table.items():
-					if transaction in lock.transactions and lock.type == self.WLOCK:
-						self.curr_vals[var] = self.commit_vals[var][-1][0]
+				for var in self.locks_held.get(transaction, ()):
+					if self.lock_mode[var] == self.WLOCK:
+						self.curr_vals.pop(var, None)
 
 			# commit a specific variable at time t 
-			def commit_value(self, var, time):
-				self.commit_vals[var].append((self.curr_vals[var], time))
-				# self.curr_vals.pop(var) # Q: do i need to clear the curr value?
-
-				if var in self.is_just_recovered and self.is_just_recovered[var] == True:
-					self.is_just_recovered[var] = False
-
-				# if all replicated variables have a commit after the site recovers -> change site's status to UP
-				is_all_variables_recovered = True
-				for var, status in self.is_just_recovered.items():
-					if status == True:
-						is_all_variables_recovered = False
-						break
-				if is_all_variables_recovered:
-					self.status = self.UP
-
-			# no longer use
-			def commit_values(self, time):
-				for variable, val in self.curr_vals.items():
-					self.commit_vals[variable].append((val, time))
-
-					# handle recover case
-					if variable in self.is_just_recovered and self.is_just_recovered[variable] == True:
-						self.is_just_recovered[variable] == False;
-
-				self.curr_vals.clear()
+			# versions older than the newest version committed before watermark are dropped, no reader can see them
+			# Output: True if this commit made the recovering site UP again
+			def commit_value(self, var, time, watermark):
+				versions = self.commit_vals.get(var)
+				if versions is None: # first commit at this site: the chain starts with the initial value
+					versions = self.commit_vals[var] = self.VersionChain()
+					versions.add(self.placement.initial_values[var], 0)
+				value = self.curr_value(var)
+				versions.add(value, time)
+				versions.prune(watermark)
+				if self.commit_log is not None:
+					self.commit_log.append(var, value, time)
+				self.curr_vals.pop(var, None) # committed, the last commit value is the current value again
+
+				if self.committed_since.get(var, 0) != self.recovery_no:
+					self.committed_since[var] = self.recovery_no
+					if self.placement.replicated[var]:
+						self.num_of_unreadable -= 1
 
 				# if all replicated variables have a commit after the site recovers -> change site's status to UP
-				is_all_variables_recovered = True
-				for var, status in self.is_just_recovered.items():
-					if status == True:
-						is_all_variables_recovered = False
-						break
-				if is_all_variables_recovered:
+				if self.num_of_unreadable == 0 and self.status != self.UP:
 					self.status = self.UP
+					return True
+				return False
 
-			def print_commit_vals(self):
-				for var in self.commit_vals:
-					print ("%s: %d," % (var, self.commit_vals[var][-1][0]), end = " ")
-				print("\n")
+			# output: list of (var, last committed value), in variable order
+			def committed_values(self):
+				if self.status == self.DOWN and self.commit_log is not None: # only the log knows them
+					last_values = {var: value for var, value, time in self.commit_log.replay()}
+					return [(var, last_values.get(var, self.placement.initial_values[var])) for var in self.placement.vars_at(self.number)]
+				return [(var, self.last_commit_value(var)) for var in self.placement.vars_at(self.number)]
 
 		# initialize variables' values
 		# def initialize():
@@ -728,6 +1115,47 @@ class DB:
 
 	# def recover(site):
 
+	CHECKPOINT_VERSION = 1
+
+	# save the whole state: transactions, lock tables, waiting queues, wait-for graph, site status and version chains
+	# written to a temporary file first, so path always holds a complete checkpoint
+	def checkpoint(self, path):
+		tmp_path = path + ".tmp"
+		with open(tmp_path, "wb") as f:
+			pickle.dump((self.CHECKPOINT_VERSION, self), f, protocol=pickle.HIGHEST_PROTOCOL)
+		os.replace(tmp_path, path)
+
+	# output: the DB saved by checkpoint(path), sending its output to sink (default: text with debug output, on stdout)
+	@staticmethod
+	def restore(path, sink=None):
+		with open(path, "rb") as f:
+			version, db = pickle.load(f)
+		if version != DB.CHECKPOINT_VERSION:
+			raise ValueError("unsupported checkpoint version %s: %s" % (version, path))
+		db.set_sink(sink if sink is not None else TextSink())
+		return db
+
+	# close the commit logs, if any
+	def close(self):
+		for site in self.tm.sites[1:]:
+			if site.commit_log is not None:
+				site.commit_log.close()
+
+	def set_sink(self, sink):
+		self.sink = sink
+		self.tm.sink = sink
+		for site in self.tm.sites[1:]:
+			site.sink = sink
+
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		del state["sink"]
+		return state
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self.sink = NullSink()
+
 	def querystate(self):
 		print("\nTransaction Manager State:")
 		self.tm.print_state()
@@ -736,26 +1164,152 @@ class DB:
 		# 	s.print_state()
 
 
-def main():
-	# create a DB
-
-	# read a file line by line
-	f = open("input21.txt", "r")
-	for line in f:
-		db.tm.read_in_instruction(line)
-
-
-	relevant_tests = set([1])
-
-	for test_index_zero_based, (test_lines, lines_with_comments) in enumerate(tests_generator()):
-
-		test_num = test_index_zero_based+1
-		if test_num in relevant_tests:
-			print(f'Test num {test_num}')
-			db = DB()
-			for line in test_lines:
+# run every test of a trace on a fresh DB
+# input: iterable of raw lines (file, stdin or a multi-test string split into lines)
+#	batch_size: if set, instructions are parsed and executed in batches of this size (see TM.execute_batch)
+#	sink: shared by the DBs of every test (default: text with debug output, on stdout)
+#	checkpoint_path, checkpoint_every: if both set, the DB is saved to checkpoint_path (DB.checkpoint) every
+#		checkpoint_every instructions of a test, each checkpoint replaces the previous one
+#	resume: if set and checkpoint_path exists, skip the trace up to the checkpoint and continue from its DB,
+#		output of the skipped part isn't repeated
+#	log_dir, fsync: commit logs of the sites, see DB, every test starts with empty logs
+def run_trace(lines, batch_size=None, sink=None, checkpoint_path=None, checkpoint_every=None, resume=False, log_dir=None, fsync="tick"):
+	if sink is None:
+		sink = TextSink()
+	restored = None
+	if resume and checkpoint_path is not None and os.path.exists(checkpoint_path):
+		restored = DB.restore(checkpoint_path, sink)
+
+	for test_index, (header, instructions) in enumerate(split_tests(lines)):
+		db = None
+		executed = 0 # instructions of this test executed so far
+		if restored is not None:
+			resume_test, resume_executed = restored.trace_position
+			if test_index < resume_test:
+				continue
+			db, restored = restored, None
+			executed = resume_executed
+			instructions = islice(instructions, executed, None)
+
+		for line in instructions:
+			if db is None: # tests without instructions (e.g. comments before the first marker) don't need a DB
+				if header is not None:
+					sink.begin_test(header)
+				db = DB(sink=sink, log_dir=log_dir, fsync=fsync, truncate_logs=True)
+			if batch_size is None:
 				db.tm.read_in_instruction(line)
-			db.querystate()
+				num_of_lines = 1
+			else:
+				batch = [line] + list(islice(instructions, batch_size - 1))
+				db.tm.read_in_batch(batch)
+				num_of_lines = len(batch)
+			executed += num_of_lines
+
+			if checkpoint_every is not None and checkpoint_path is not None and executed // checkpoint_every > (executed - num_of_lines) // checkpoint_every:
+				db.trace_position = (test_index, executed)
+				db.checkpoint(checkpoint_path)
+		if db is not None:
+			if sink.verbose:
+				db.querystate()
+			db.close()
+
+# runs in a worker process: run one trace on its own DBs and return everything it printed and its result log
+# input: (trace, batch_size, output, results_format)
+#	trace: a file path or a list of lines
+#	output: a name of output_sink_util.SINKS
+#	results_format: format of the result log, None for no result log
+# output: (printed text, bytes of the result log or None)
+def run_job(job):
+	trace, batch_size, output_mode, results_format = job
+	lines = read_trace(trace) if isinstance(trace, str) else trace
+	output = io.StringIO()
+	sink = make_sink(output_mode)
+	results = None
+	if results_format is not None:
+		results = io.BytesIO()
+		sink = TeeSink(sink, ResultLogSink(results, results_format))
+	with redirect_stdout(output):
+		run_trace(lines, batch_size, sink)
+	return output.getvalue(), results.getvalue() if results is not None else None
+
+# run independent traces in a pool of worker processes
+# output: generator of (printed text, result log) of each trace, in the order of traces, see run_job
+def run_parallel(traces, batch_size=None, processes=None, output_mode="debug", results_format=None):
+	with Pool(processes) as pool:
+		for output in pool.imap(run_job, [(trace, batch_size, output_mode, results_format) for trace in traces]):
+			yield output
+
+# every test of a multi-test string as a separate trace (list of lines starting with its marker)
+def split_test_str(big_str):
+	return [([header] if header is not None else []) + list(instructions) for header, instructions in split_tests(big_str.splitlines())]
+
+# argparse type of options that need a count of at least 1
+def positive_int(text):
+	value = int(text)
+	if value < 1:
+		raise argparse.ArgumentTypeError("must be at least 1: %s" % text)
+	return value
+
+# usage: python project.py [--builtin] [--batch N] [--jobs N] [--output MODE] [--results PATH [--results-format FORMAT]]
+#	[--checkpoint PATH [--checkpoint-every N] [--resume]] [--log-dir DIR [--fsync POLICY]] [trace file ...]
+#	no file or "-": read from stdin
+def main():
+	parser = argparse.ArgumentParser(description="Replicated concurrency control and recovery")
+	parser.add_argument("paths", nargs="*", help='trace files, "-" for stdin (default)')
+	parser.add_argument("--builtin", action="store_true", help="run the tests in test_cases.py")
+	parser.add_argument("--batch", type=positive_int, metavar="N", help="execute N instructions per batch, detect deadlocks once per batch")
+	parser.add_argument("--jobs", type=int, metavar="N", help="run each trace (each builtin test) in one of N worker processes, 0 for one per core")
+	parser.add_argument("--output", choices=sorted(SINKS), default="debug", help="debug: results and debug output (default), text: results only, none: nothing")
+	parser.add_argument("--results", metavar="PATH", help="also write a result log of reads, commits, aborts and dumps to PATH")
+	parser.add_argument("--results-format", choices=RESULT_FORMATS, default="binary", help="format of the result log (default: binary)")
+	parser.add_argument("--checkpoint", metavar="PATH", help="checkpoint file of the replay, see --checkpoint-every and --resume")
+	parser.add_argument("--checkpoint-every", type=positive_int, metavar="N", help="save the DB state to the checkpoint file every N instructions")
+	parser.add_argument("--resume", action="store_true", help="continue the replay from the checkpoint file if it exists")
+	parser.add_argument("--log-dir", metavar="DIR", help="keep a commit log per site in DIR, failed sites recover from it")
+	parser.add_argument("--fsync", choices=FSYNC_POLICIES, default="tick", help="when commit logs are synced to disk (default: tick, a group commit per tick)")
+	args = parser.parse_args()
+	results_format = args.results_format if args.results is not None else None
+	if args.checkpoint is not None and (args.jobs is not None or len(args.paths) + args.builtin > 1):
+		parser.error("--checkpoint needs a single trace and no --jobs")
+	if (args.checkpoint_every is not None or args.resume) and args.checkpoint is None:
+		parser.error("--checkpoint-every and --resume need --checkpoint")
+	if args.log_dir is not None and args.jobs is not None:
+		parser.error("--log-dir can't be used with --jobs")
+	replay_options = dict(checkpoint_path=args.checkpoint, checkpoint_every=args.checkpoint_every, resume=args.resume,
+		log_dir=args.log_dir, fsync=args.fsync)
+
+	if args.jobs is not None:
+		traces = split_test_str(test_str) if args.builtin else []
+		if not args.builtin and not args.paths:
+			args.paths = ['-']
+		# workers don't share our stdin, read it here and pass its lines
+		traces.extend(list(read_trace(path)) if path == '-' else path for path in args.paths)
+		results = open(args.results, "wb", buffering=1 << 16) if args.results is not None else None
+		try:
+			for output, result_log in run_parallel(traces, args.batch, args.jobs or None, args.output, results_format):
+				print(output, end="")
+				if results is not None:
+					results.write(result_log)
+		finally:
+			if results is not None:
+				results.close()
+		return
+
+	sink = make_sink(args.output)
+	results = None
+	if args.results is not None:
+		results = ResultLogSink(args.results, results_format)
+		sink = TeeSink(sink, results)
+	try:
+		if args.builtin:
+			run_trace(test_str.splitlines(), args.batch, sink, **replay_options)
+		elif not args.paths:
+			args.paths = ['-']
+		for path in args.paths:
+			run_trace(read_trace(path), args.batch, sink, **replay_options)
+	finally:
+		if results is not None:
+			results.close()
 
 if __name__ == "__main__":
     main()
@@ -399,7 +399,7 @@ begin(T1)
 begin(T2)
 R(T2, x2)
 W(T1, x2, 202)
-W(T2 x2, 302)
+W(T2,x2, 302)
 end(T1)
 dump()
 '''
@@ -0,0 +1,57 @@
+# streaming front end for trace files
+# everything here is a generator over lines, so a trace is never held in memory as a whole
+
+import sys
+from itertools import chain, groupby
+
+TEST_MARKER = '// Test'
+
+# input: iterable of raw lines
+# output: generator of instructions, comments (whole line or trailing "// ...") and blank lines skipped
+def read_instructions(lines):
+	for line in lines:
+		line = line.split('//', 1)[0].strip()
+		if line != '':
+			yield line
+
+# split a multi-test trace on "// Test" markers, lazily
+# input: iterable of raw lines
+# output: generator of (header, instructions)
+#	header: the marker line, or None for lines before the first marker
+#	instructions: generator of instructions of that test, must be consumed before moving to the next test
+def split_tests(lines):
+	test_index = [0]
+	def key(line):
+		if line.startswith(TEST_MARKER):
+			test_index[0] += 1
+		return test_index[0]
+
+	for index, group in groupby(lines, key):
+		first = next(group)
+		if first.startswith(TEST_MARKER):
+			yield first.strip(), read_instructions(group)
+		else:
+			yield None, read_instructions(chain([first], group))
+
+# output: generator of lines of a trace file, "-" means stdin
+def read_trace(path):
+	if path == '-':
+		for line in sys.stdin:
+			yield line
+		return
+	with open(path, 'r') as f:
+		for line in f:
+			yield line
+
+
+# =============== TESTS ==================
+
+def test_split_tests():
+	lines = ['begin(T0)', '', '// Test 1', '// comment', 'begin(T1)', 'fail(1) // T1 abort', '// Test 2', 'end(T2)']
+	tests = [(header, list(instructions)) for header, instructions in split_tests(lines)]
+	assert(tests == [(None, ['begin(T0)']), ('// Test 1', ['begin(T1)', 'fail(1)']), ('// Test 2', ['end(T2)'])])
+
+def main():
+	test_split_tests()
+if __name__ == '__main__':
+	main()